@@ -20,6 +20,7 @@ from turn_relevance_annotator import TurnRelevanceAnnotator
 
 from convinse.library.utils import get_config, get_logger
 from convinse.library.string_library import StringLibrary as string_lib
+from convinse.library.label_store import get_label_store
 
 
 class NoFlowGraphFoundException(Exception):
@@ -41,10 +42,8 @@ class SilverAnnotation:
         self.fg_annotator = ConvFlowAnnotator(self.clocq, config)
         self.tr_annotator = TurnRelevanceAnnotator(config)
 
-        #  open labels
-        labels_path = config["path_to_labels"]
-        with open(labels_path, "r") as fp:
-            self.labels_dict = json.load(fp)
+        #  open labels (shared label store)
+        self.labels_dict = get_label_store(config)
 
     def process_dataset(self, dataset_path, output_path, tr_data_path):
         """
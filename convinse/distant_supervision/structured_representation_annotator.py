@@ -1,10 +1,10 @@
 import os
-import json
 import sys
 import time
 
 from convinse.library.utils import get_logger
 from convinse.library.string_library import StringLibrary
+from convinse.library.label_store import get_label_store
 
 
 class StructuredRepresentationAnnotator:
@@ -13,8 +13,7 @@ class StructuredRepresentationAnnotator:
         self.config = config
 
         self.string_lib = StringLibrary(config)
-        with open(config["path_to_labels"], "r") as fp:
-            self.labels_dict = json.load(fp)
+        self.labels_dict = get_label_store(config)
 
         self.type_relevance_cache = dict()
 
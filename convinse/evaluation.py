@@ -1,10 +1,25 @@
+import os
+import sys
+import glob
 import json
+import heapq
 
 from tqdm import tqdm
 
+from convinse.library.utils import get_config
 from convinse.library.string_library import StringLibrary
 from Levenshtein import distance as levenshtein_distance
 
+# the edit distance can be bounded in more recent versions of Levenshtein
+try:
+    levenshtein_distance("", "", score_cutoff=0)
+    LEVENSHTEIN_SCORE_CUTOFF = True
+except TypeError:
+    LEVENSHTEIN_SCORE_CUTOFF = False
+
+# metrics reported by the evaluation of result files
+METRICS = ["p_at_1", "mrr", "h_at_5", "answer_presence"]
+
 
 def answer_presence(evidences, answers):
     """
@@ -16,10 +31,11 @@ def answer_presence(evidences, answers):
     # initialize
     answer_present = False
     answering_evidences = list()
+    gold_ids = gold_answer_ids(answers)
 
     # go through evidences
     for evidence in evidences:
-        if evidence_has_answer(evidence, answers):
+        if _evidence_has_gold_id(evidence, gold_ids):
             # remember evidence
             answer_present = True
             answering_evidences.append(evidence)
@@ -29,69 +45,52 @@ def answer_presence(evidences, answers):
 
 def evidence_has_answer(evidence, gold_answers):
     """Check whether the given evidence has any of the answers."""
-    for answer_candidate in evidence["wikidata_entities"]:
-        # check if answering candidate
-        if candidate_in_answers(answer_candidate, gold_answers):
-            return True
-    return False
+    return _evidence_has_gold_id(evidence, gold_answer_ids(gold_answers))
 
 
 def candidate_in_answers(answer_candidate, gold_answers):
     """Check if candidate is answer."""
-    # get ids
-    answer_candidate_id = answer_candidate["id"]
-    gold_answer_ids = [answer["id"] for answer in gold_answers]
+    return _candidate_id(answer_candidate) in gold_answer_ids(gold_answers)
 
-    # normalize
-    answer_candidate_id = answer_candidate_id.lower().strip().replace('"', "").replace("+", "")
-    gold_answer_ids = [answer.lower().strip().replace('"', "") for answer in gold_answer_ids]
 
-    # perform check
-    if answer_candidate_id in gold_answer_ids:
-        return True
+def gold_answer_ids(gold_answers):
+    """Normalized IDs of the gold answers (to be computed once per turn)."""
+    return set(answer["id"].lower().strip().replace('"', "") for answer in gold_answers)
 
-    # no match found
-    return False
+
+def _candidate_id(answer_candidate):
+    """Normalized ID of the answer candidate."""
+    return answer_candidate["id"].lower().strip().replace('"', "").replace("+", "")
+
+
+def _evidence_has_gold_id(evidence, gold_ids):
+    return any(_candidate_id(candidate) in gold_ids for candidate in evidence["wikidata_entities"])
+
+
+def _first_correct_rank(answers, gold_ids):
+    """Rank of the first correct answer in the (ranked) answers, None if there is no correct answer."""
+    for answer in answers:
+        if _candidate_id(answer["answer"]) in gold_ids:
+            return float(answer["rank"])
+    return None
 
 
 def mrr_score(answers, gold_answers):
     """Compute MRR score for given answers and gold answers."""
-    # check if any answer was given
-    if not answers:
-        return 0.0
-    # go through answer candidates
-    for answer in answers:
-        if candidate_in_answers(answer["answer"], gold_answers):
-            return 1.0 / float(answer["rank"])
-    return 0.0
+    rank = _first_correct_rank(answers, gold_answer_ids(gold_answers))
+    return 0.0 if rank is None else 1.0 / rank
 
 
 def precision_at_1(answers, gold_answers):
     """Compute P@1 score for given answers and gold answers."""
-    # check if any answer was given
-    if not answers:
-        return 0.0
-    # go through answer candidates
-    for answer in answers:
-        if float(answer["rank"]) > float(1.0):
-            break
-        elif candidate_in_answers(answer["answer"], gold_answers):
-            return 1.0
-    return 0.0
+    rank = _first_correct_rank(answers, gold_answer_ids(gold_answers))
+    return 1.0 if rank is not None and rank <= 1.0 else 0.0
 
 
 def hit_at_5(answers, gold_answers):
     """Compute Hit@5 score for given answers and gold answers."""
-    # check if any answer was given
-    if not answers:
-        return 0.0
-    # go through answer candidates
-    for answer in answers:
-        if float(answer["rank"]) > float(5.0):
-            break
-        elif candidate_in_answers(answer["answer"], gold_answers):
-            return 1.0
-    return 0.0
+    rank = _first_correct_rank(answers, gold_answer_ids(gold_answers))
+    return 1.0 if rank is not None and rank <= 5.0 else 0.0
 
 
 def get_ranked_answers(config, generated_answer, turn):
@@ -112,35 +111,10 @@ def get_ranked_answers(config, generated_answer, turn):
         # return dummy answer in case None was found (if no evidences found)
         if generated_answer is None:
             return [{"answer": {"id": "None", "label": "None"}, "rank": 1, "score": 0.0}]
-        smallest_diff = 100000
-        all_answers = list()
-        mentions = set()
-        for evidence in turn["top_evidences"]:
-            for disambiguation in evidence["disambiguations"]:
-                mention = disambiguation[0]
-                id = disambiguation[1]
-                if id is None or id == False:
-                    continue
-
-                # skip duplicates
-                ans = str(mention) + str(id)
-                if ans in mentions:
-                    continue
-                mentions.add(ans)
-                # exact match
-                if generated_answer == mention:
-                    diff = 0
-                # otherwise compute edit distance
-                else:
-                    diff = levenshtein_distance(generated_answer, mention)
-
-                all_answers.append({"answer": {"id": id, "label": mention}, "score": diff})
-
-        sorted_answers = sorted(all_answers, key = lambda j: j['score'])
-        ranked_answers = [
-            {"answer": answer["answer"], "score": answer["score"], "rank": i+1}
-            for i, answer in enumerate(sorted_answers)
-        ]
+        # rank candidates of the top evidences
+        evidences = turn["top_evidences"][: config["evs_max_evidences"]]
+        candidates = answer_candidates(evidences)
+        ranked_answers = rank_candidates(generated_answer, candidates, config["ha_max_answers"])
 
     # don't return all answers
     max_answers = config["ha_max_answers"]
@@ -150,6 +124,75 @@ def get_ranked_answers(config, generated_answer, turn):
     return ranked_answers
 
 
+def answer_candidates(evidences):
+    """
+    Build the candidate index for the given evidences: each (deduplicated) mention
+    maps to its (first position, KB item ID) pairs, in the order of their first occurrence.
+    """
+    candidates = dict()
+    seen = set()
+    for evidence in evidences:
+        for disambiguation in evidence["disambiguations"]:
+            mention, id = disambiguation[0], disambiguation[1]
+            if id is None or id == False:
+                continue
+            # skip duplicates
+            if (mention, id) in seen:
+                continue
+            candidates.setdefault(mention, list()).append((len(seen), id))
+            seen.add((mention, id))
+    return candidates
+
+
+def rank_candidates(generated_answer, candidates, max_answers):
+    """
+    Rank the candidates by the edit distance of their mention to the generated answer
+    (ties are broken by the position of the first occurrence), and return the top answers.
+    Exact matches are found via the mention index, and edit distances are
+    only computed up to the distance of the current k-th best candidate.
+    """
+    if max_answers <= 0:
+        return list()
+
+    # max-heap of the best candidates so far: (-distance, -position, mention, id)
+    heap = list()
+    for mention, occurrences in candidates.items():
+        # distance of the k-th best candidate (None if less than k candidates)
+        bound = -heap[0][0] if len(heap) >= max_answers else None
+        if mention == generated_answer:
+            distance = 0
+        elif bound is None:
+            distance = levenshtein_distance(generated_answer, mention)
+        # difference in length is a lower bound for the edit distance
+        elif abs(len(generated_answer) - len(mention)) > bound:
+            continue
+        else:
+            distance = _bounded_levenshtein_distance(generated_answer, mention, bound)
+
+        for position, id in occurrences:
+            candidate = (-distance, -position, mention, id)
+            if len(heap) < max_answers:
+                heapq.heappush(heap, candidate)
+            elif candidate > heap[0]:
+                heapq.heapreplace(heap, candidate)
+
+    # sort by distance and position
+    return [
+        {"answer": {"id": id, "label": mention}, "score": -distance, "rank": i + 1}
+        for i, (distance, _, mention, id) in enumerate(sorted(heap, reverse=True))
+    ]
+
+
+def _bounded_levenshtein_distance(s1, s2, bound):
+    """
+    Edit distance between the strings, which is exact up to the bound
+    (and larger than the bound otherwise).
+    """
+    if LEVENSHTEIN_SCORE_CUTOFF:
+        return levenshtein_distance(s1, s2, score_cutoff=bound)
+    return levenshtein_distance(s1, s2)
+
+
 def question_is_existential(question):
     existential_keywords = [
         "is",
@@ -176,3 +219,130 @@ def question_is_existential(question):
         if lowercase_question.startswith(keyword):
             return True
     return False
+
+
+def evaluate_turns(turns):
+    """
+    Compute the metrics for the given (answered) turns in one pass,
+    with breakdowns by turn position, answer source and question type.
+    Metrics are computed from the stored predicted answers, such that
+    results can be evaluated without re-running the pipeline.
+    """
+    results = {
+        "overall": _new_metrics(),
+        "by_turn": dict(),
+        "by_answer_source": dict(),
+        "by_question_type": dict(),
+    }
+    for turn in turns:
+        # normalize gold answers once per turn
+        gold_ids = gold_answer_ids(turn["answers"])
+        pred_answers = [
+            {"answer": answer, "rank": answer["rank"]} for answer in turn.get("pred_answers", list())
+        ]
+        rank = _first_correct_rank(pred_answers, gold_ids)
+        scores = {
+            "p_at_1": 1.0 if rank is not None and rank <= 1.0 else 0.0,
+            "mrr": 0.0 if rank is None else 1.0 / rank,
+            "h_at_5": 1.0 if rank is not None and rank <= 5.0 else 0.0,
+            "answer_presence": float(bool(turn.get("answer_presence"))),
+        }
+
+        # aggregate
+        question_type = "existential" if question_is_existential(turn["question"]) else "factoid"
+        groups = [
+            results["overall"],
+            results["by_turn"].setdefault(turn.get("turn"), _new_metrics()),
+            results["by_answer_source"].setdefault(turn.get("answer_src"), _new_metrics()),
+            results["by_question_type"].setdefault(question_type, _new_metrics()),
+        ]
+        for metrics in groups:
+            metrics["num_questions"] += 1
+            for metric, score in scores.items():
+                metrics[metric] += score
+
+    # average
+    for metrics in _all_metrics(results):
+        num_questions = max(metrics["num_questions"], 1)
+        for metric in METRICS:
+            metrics[metric] = round(metrics[metric] / num_questions, 3)
+    return results
+
+
+def evaluate_result_file(path):
+    """Evaluate the stored results (list of conversations) at the given path."""
+    with open(path, "r") as fp:
+        data = json.load(fp)
+    turns = [turn for conversation in data for turn in conversation["questions"]]
+    return evaluate_turns(turns)
+
+
+def format_results(results):
+    """Format the results (incl. breakdowns) as lines of text."""
+
+    def _format(name, metrics):
+        scores = ", ".join(f"{metric} {metrics[metric]}" for metric in METRICS)
+        return f"{name} ({metrics['num_questions']}): {scores}"
+
+    lines = [_format("Overall", results["overall"])]
+    for breakdown in ["by_turn", "by_answer_source", "by_question_type"]:
+        for key, metrics in sorted(results[breakdown].items(), key=lambda item: str(item[0])):
+            lines.append(_format(f"{breakdown} - {key}", metrics))
+    return lines
+
+
+def _new_metrics():
+    metrics = {metric: 0.0 for metric in METRICS}
+    metrics["num_questions"] = 0
+    return metrics
+
+
+def _all_metrics(results):
+    yield results["overall"]
+    for breakdown in ["by_turn", "by_answer_source", "by_question_type"]:
+        yield from results[breakdown].values()
+
+
+#######################################################################################################################
+#######################################################################################################################
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise Exception(
+            "Usage: python convinse/evaluation.py --<gold-answers/pred-answers> <PATH_TO_CONFIG> [<SOURCES_STRING>]"
+        )
+
+    function = sys.argv[1]
+    config_path = sys.argv[2]
+    config = get_config(config_path)
+
+    # evaluate all source combinations (for which results are stored), or the given one
+    source_combinations = ["kb_text_table_info", "kb", "text", "table", "info", "kb_text", "kb_table", "kb_info", "text_table", "text_info", "table_info"]
+    if len(sys.argv) > 3:
+        source_combinations = [sys.argv[3]]
+
+    name = config["name"]
+    qu = config["qu"]
+    ers = config["ers"]
+    ha = config["ha"]
+    input_dir = os.path.join(config["path_to_intermediate_results"], qu, ers)
+    for sources_str in source_combinations:
+        output_dir = os.path.join(input_dir, sources_str, ha)
+        if function == "--gold-answers":
+            result_path = os.path.join(output_dir, f"res_{name}_gold_answers.json")
+        elif function == "--pred-answers":
+            # results after the last turn
+            turn_paths = glob.glob(os.path.join(output_dir, "res_turn_*.json"))
+            turn_ids = [int(path.rsplit("_", 1)[1].split(".")[0]) for path in turn_paths]
+            result_path = os.path.join(output_dir, f"res_turn_{max(turn_ids)}.json") if turn_ids else ""
+        else:
+            raise Exception(f"Unknown function {function}!")
+        if not os.path.isfile(result_path):
+            continue
+
+        # evaluate stored results
+        results = evaluate_result_file(result_path)
+        lines = format_results(results)
+        output_path = os.path.join(output_dir, f"{function[2:]}.res")
+        with open(output_path, "w") as fp:
+            fp.write("\n".join(lines))
+        print(f"{sources_str}: {lines[0]}")
@@ -1,54 +1,244 @@
 import json
+import hashlib
+import numpy as np
 
-from rank_bm25 import BM25Okapi
+from scipy import sparse
+
+from convinse.evidence_retrieval_scoring.evidence_index import EvidenceIndex
+
+# BM25 parameters (same defaults as rank_bm25.BM25Okapi)
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
 
 
 class BM25Scoring:
     def __init__(self, config):
         with open(config["path_to_stopwords"], "r") as fp:
-            self.stopwords = fp.read().split("\n")
+            self.stopwords = frozenset(fp.read().split("\n"))
 
         self.max_evidences = config["evs_max_evidences"]
+        # full ranking is stored up to this depth (any k <= max is a prefix)
+        self.max_ranked_evidences = max(config["evs_max_ranked_evidences"], self.max_evidences)
         if config["qu"] == "sr":
             self.sr_delimiter = config["sr_delimiter"].strip()
         else:
             self.sr_delimiter = " "
 
+        # pre-tokenized evidences (per entity)
+        self.evidence_index = EvidenceIndex(config, self.tokenize)
+
+    def tokenize(self, string):
+        """Function to tokenize string (word-level)."""
+        string = string.replace(",", " ")
+        string = string.replace(self.sr_delimiter, " ")
+        string = string.strip()
+        return [word.lower() for word in string.split() if not word in self.stopwords]
+
     def get_top_evidences(self, structured_representation, evidences):
         """
-        Retrieve the top-100 evidences among the retrieved ones,
-        for the given AR.
+        Rank the retrieved evidences for the given SR (up to `evs_max_ranked_evidences`).
+        The top-k evidences for any smaller k are a prefix of the ranking.
+        """
+        return self.get_top_evidences_batch([structured_representation], [evidences])[0]
+
+    def get_top_evidences_batch(self, structured_representations, evidence_pools, tf_matrices=None):
+        """
+        Rank the evidences for each (SR, evidences) pair.
+        Ranked evidences are (shallow) copies, with their BM25 score.
+        """
+        rankings = self.rank_batch(structured_representations, evidence_pools, tf_matrices)
+        return [
+            ranking_to_evidences(evidences, ranking)
+            for evidences, ranking in zip(evidence_pools, rankings)
+        ]
+
+    def rank_batch(self, structured_representations, evidence_pools, tf_matrices=None):
+        """
+        Rank the evidences for each (SR, evidences) pair.
+        Returns the ranked indices (into the pool) and the BM25 scores for each pair.
+        Identical pools (e.g. retrieved in different turns) are indexed once,
+        and all SRs for a pool are scored within a single matrix product.
+        Term-frequency matrices already assembled for a pool (e.g. during pruning)
+        can be given in `tf_matrices` (None entries are assembled from the index).
         """
+        if tf_matrices is None:
+            tf_matrices = [None] * len(evidence_pools)
+
+        # merge identical pools
+        pool_to_queries = dict()
+        for query_index, evidences in enumerate(evidence_pools):
+            pool_key = pool_hash(evidences)
+            pool_to_queries.setdefault(pool_key, list()).append(query_index)
+
+        empty_ranking = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+        rankings = [empty_ranking for _ in evidence_pools]
+        for query_indices in pool_to_queries.values():
+            evidences = evidence_pools[query_indices[0]]
+            if not evidences:
+                continue
+
+            # assemble corpus from the pre-tokenized evidences (if not given)
+            tf_matrix = tf_matrices[query_indices[0]]
+            if tf_matrix is None:
+                tf_matrix = self.evidence_index.get_tf_matrix(evidences)
+            bm25_index = BM25Index(tf_matrix, self.evidence_index.vocabulary)
 
-        def tokenize(string):
-            """Function to tokenize string (word-level)."""
-            string = string.replace(",", " ")
-            string = string.replace(self.sr_delimiter, " ")
-            string = string.strip()
-            return [word.lower() for word in string.split() if not word in self.stopwords]
+            # scoring (documents x queries)
+            tokenized_srs = [
+                self.tokenize(structured_representations[query_index])
+                for query_index in query_indices
+            ]
+            scores = bm25_index.get_scores_batch(tokenized_srs)
 
+            # retrieve ranking
+            for column, query_index in enumerate(query_indices):
+                ranked_indices = top_k_indices(scores[:, column], self.max_ranked_evidences)
+                rankings[query_index] = (ranked_indices, scores[ranked_indices, column])
+        return rankings
+
+    def get_tf_matrix(self, evidences):
+        """Term-frequency matrix (evidences x token IDs) of the given evidences."""
         if not evidences:
-            return evidences
+            return sparse.csr_matrix((0, len(self.evidence_index.vocabulary)), dtype=np.int32)
+        return self.evidence_index.get_tf_matrix(evidences)
 
-        # tokenize
-        mapping = {
-            " ".join(tokenize(evidence["evidence_text"])): evidence for evidence in evidences
-        }
-        tokenized_sr = tokenize(structured_representation)
+    def get_term_overlaps(self, structured_representation, tf_matrix):
+        """
+        Number of distinct SR tokens occuring in each of the evidences (rows of the tf matrix).
+        Cheap first-stage signal (no BM25 weights are computed).
+        """
+        vocabulary = self.evidence_index.vocabulary
+        query_tokens = set(self.tokenize(structured_representation))
+        query_term_ids = np.array(
+            [vocabulary[token] for token in query_tokens if token in vocabulary], dtype=np.int64
+        )
+        rows = np.repeat(np.arange(tf_matrix.shape[0]), np.diff(tf_matrix.indptr))
+        matches = np.isin(tf_matrix.indices, query_term_ids)
+        return np.bincount(rows[matches], minlength=tf_matrix.shape[0])
 
-        # create corpus
-        tokenized_corpus = [tokenize(evidence["evidence_text"]) for evidence in evidences]
-        bm25_module = BM25Okapi(tokenized_corpus)
+    def store_index(self):
+        """Store the index of pre-tokenized evidences."""
+        self.evidence_index.store()
 
-        # scoring
-        scores = bm25_module.get_scores(tokenized_sr)
 
-        # retrieve top-k
-        ranked_indices = sorted(
-            range(len(tokenized_corpus)), key=lambda i: scores[i], reverse=True
-        )[: self.max_evidences]
+class BM25Index:
+    """
+    BM25 (Okapi) index over a corpus, based on a sparse term-frequency matrix.
+    Scores are the same as computed by rank_bm25.BM25Okapi.
+    """
 
-        scored_evidences = [
-            mapping[" ".join(tokenized_corpus[index])] for i, index in enumerate(ranked_indices)
-        ]
-        return scored_evidences
+    def __init__(self, tf_matrix, vocabulary, k1=BM25_K1, b=BM25_B, epsilon=BM25_EPSILON):
+        """
+        Create the index for the given term-frequency matrix (documents x term IDs),
+        with the vocabulary mapping from tokens to the term IDs.
+        Only the terms occuring in the corpus are kept as columns of the weight matrix.
+        """
+        self.vocabulary = vocabulary
+        tf_matrix = sparse.csr_matrix(tf_matrix, dtype=np.float64)
+        tf_matrix.sum_duplicates()
+        num_docs = tf_matrix.shape[0]
+
+        # document lengths
+        doc_lengths = np.asarray(tf_matrix.sum(axis=1)).ravel()
+        avg_doc_length = doc_lengths.mean() if num_docs else 0.0
+
+        # terms in corpus (sorted term IDs) and their document frequencies
+        self.term_ids, columns, doc_freqs = np.unique(
+            tf_matrix.indices, return_inverse=True, return_counts=True
+        )
+        num_terms = len(self.term_ids)
+
+        # inverse document frequencies
+        idf = np.log(num_docs - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+        if num_terms:
+            # negative idfs are replaced by a fraction of the average idf
+            average_idf = idf.mean()
+            idf[idf < 0] = epsilon * average_idf
+
+        # term weights per document: idf * tf * (k1 + 1) / (tf + k1 * norm)
+        if avg_doc_length > 0:
+            norms = k1 * (1 - b + b * doc_lengths / avg_doc_length)
+        else:
+            norms = np.full(num_docs, k1 * (1 - b))
+        rows = np.repeat(np.arange(num_docs), np.diff(tf_matrix.indptr))
+        tfs = tf_matrix.data
+        weights = idf[columns] * tfs * (k1 + 1) / (tfs + norms[rows])
+        self.weights = sparse.csr_matrix(
+            (weights, columns, tf_matrix.indptr), shape=(num_docs, num_terms)
+        )
+
+    @classmethod
+    def from_tokenized_corpus(cls, tokenized_corpus, **kwargs):
+        """Create the index for the given corpus (list of token lists)."""
+        vocabulary = dict()
+        indptr = [0]
+        indices = list()
+        for tokens in tokenized_corpus:
+            for token in tokens:
+                indices.append(vocabulary.setdefault(token, len(vocabulary)))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float64)
+        tf_matrix = sparse.csr_matrix(
+            (data, indices, indptr), shape=(len(tokenized_corpus), len(vocabulary))
+        )
+        return cls(tf_matrix, vocabulary, **kwargs)
+
+    def query_vector(self, query_tokens):
+        """Count vector of the given query tokens (tokens not in the corpus are dropped)."""
+        term_ids = np.array(
+            [self.vocabulary[token] for token in query_tokens if token in self.vocabulary],
+            dtype=np.int64,
+        )
+        columns = np.searchsorted(self.term_ids, term_ids)
+        in_corpus = columns < len(self.term_ids)
+        in_corpus[in_corpus] = self.term_ids[columns[in_corpus]] == term_ids[in_corpus]
+        return np.bincount(columns[in_corpus], minlength=len(self.term_ids)).astype(np.float64)
+
+    def get_scores(self, query_tokens):
+        """Compute the BM25 scores of all documents for the given query tokens."""
+        return self.weights @ self.query_vector(query_tokens)
+
+    def get_scores_batch(self, queries_tokens):
+        """Compute the BM25 scores of all documents for each query (documents x queries)."""
+        query_matrix = np.stack(
+            [self.query_vector(query_tokens) for query_tokens in queries_tokens], axis=1
+        )
+        return np.asarray(self.weights @ query_matrix)
+
+
+def ranking_to_evidences(evidences, ranking):
+    """Ranked (shallow) copies of the evidences, with their scores."""
+    ranked_indices, scores = ranking
+    return [
+        dict(evidences[index], score=float(score)) for index, score in zip(ranked_indices, scores)
+    ]
+
+
+def pool_hash(evidences):
+    """
+    Compact identity of a pool of evidences: hash of the
+    texts of its evidences and the entities they were retrieved for.
+    """
+    hash_ = hashlib.blake2b(digest_size=16)
+    for evidence in evidences:
+        retrieved_for_entity = evidence.get("retrieved_for_entity")
+        entity_id = retrieved_for_entity["id"] if retrieved_for_entity else None
+        hash_.update(json.dumps([entity_id, evidence["evidence_text"]]).encode("utf-8"))
+    return hash_.digest()
+
+
+def top_k_indices(scores, k):
+    """
+    Return the indices of the k highest scores in descending order.
+    Ties are broken by the index (as in a stable sort).
+    """
+    num_scores = len(scores)
+    if k < num_scores:
+        # k-th highest score -> candidates (all scores >= threshold)
+        kth_index = np.argpartition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= scores[kth_index])
+    else:
+        candidates = np.arange(num_scores)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order][:k]
@@ -4,13 +4,21 @@ import json
 import time
 import logging
 
+import numpy as np
+
 from tqdm import tqdm
 from pathlib import Path
 
 from convinse.library.utils import get_config, get_logger
+from convinse.evaluation import answer_presence
 from convinse.evidence_retrieval_scoring.evidence_retrieval_scoring import EvidenceRetrievalScoring
 from convinse.evidence_retrieval_scoring.clocq_er import ClocqRetriever
-from convinse.evidence_retrieval_scoring.bm25_es import BM25Scoring
+from convinse.evidence_retrieval_scoring.bm25_es import (
+    BM25Scoring,
+    ranking_to_evidences,
+    top_k_indices,
+)
+from convinse.evidence_retrieval_scoring.ranking_cache import RankingCache
 
 
 class ClocqBM25(EvidenceRetrievalScoring):
@@ -20,27 +28,203 @@ class ClocqBM25(EvidenceRetrievalScoring):
         self.evr = ClocqRetriever(config)
         self.evs = BM25Scoring(config)
 
+        # max. number of candidates scored with BM25 (0: no pruning)
+        self.prune_budget = config["evs_prune_budget"]
+        # number of turns retrieved and scored at once (bounds the evidence pools held in memory)
+        self.batch_turns = config["evs_batch_turns"]
+
+        # rankings are only cached if the retrieval results are (version of ER cache required)
+        self.use_ranking_cache = config["evs_use_ranking_cache"] and config["ers_use_cache"]
+        if self.use_ranking_cache:
+            self.ranking_cache = RankingCache(config)
+
     def inference_on_turn(self, turn, sources=["kb", "text", "table", "info"]):
         """Retrieve best evidences for SR."""
-        structured_representation = turn["structured_representation"]
-        evidences, _ = self.evr.retrieve_evidences(structured_representation, sources)
-        top_evidences = self.evs.get_top_evidences(structured_representation, evidences)
+        top_evidences = self.rank_evidences([turn], sources)[0]
         turn["top_evidences"] = top_evidences
         return top_evidences
 
+    def inference_on_turns(self, input_turns, sources=["kb", "text", "table", "info"]):
+        """
+        Retrieve best evidences for the SRs of all given turns.
+        Turns are processed in chunks of consecutive turns, such that only the
+        evidence pools of a single chunk are held in memory.
+        """
+        for start in tqdm(range(0, len(input_turns), self.batch_turns)):
+            turns = input_turns[start : start + self.batch_turns]
+            top_evidences = self.rank_evidences(turns, sources)
+            for turn, turn_top_evidences in zip(turns, top_evidences):
+                self.set_top_evidences(turn, turn_top_evidences)
+        self.evr.log_budget_hits()
+        return input_turns
+
+    def rank_evidences(self, input_turns, sources):
+        """
+        Retrieve and rank the evidences for the SRs of all given turns.
+        Rankings are looked-up in the ranking cache (if possible), and all
+        remaining turns are scored in batch, such that turns with identical
+        evidence pools share a single index.
+        """
+        evidence_pools = list()
+        rankings = list()
+        for turn in input_turns:
+            structured_representation = turn["structured_representation"]
+            evidences, _ = self.evr.retrieve_evidences(structured_representation, sources)
+            evidence_pools.append(evidences)
+            rankings.append(self._lookup_ranking(structured_representation, sources, evidences))
+
+        # batched scoring (of pruned pools) for rankings not in cache
+        missing = [i for i, ranking in enumerate(rankings) if ranking is None]
+        self.logger.debug(f"Rankings found in cache for {len(rankings) - len(missing)} turns.")
+        structured_representations = [input_turns[i]["structured_representation"] for i in missing]
+        kept_indices = list()
+        pruned_tf_matrices = list()
+        for sr, i in zip(structured_representations, missing):
+            indices, tf_matrix = self.prune(sr, evidence_pools[i])
+            kept_indices.append(indices)
+            pruned_tf_matrices.append(tf_matrix)
+        pruned_pools = [
+            [evidence_pools[i][index] for index in indices]
+            for i, indices in zip(missing, kept_indices)
+        ]
+        pruned_rankings = self.evs.rank_batch(
+            structured_representations, pruned_pools, pruned_tf_matrices
+        )
+        for turn_index, structured_representation, indices, pruned_ranking in zip(
+            missing, structured_representations, kept_indices, pruned_rankings
+        ):
+            # map ranking to indices in the retrieved pool
+            ranked_indices, scores = pruned_ranking
+            rankings[turn_index] = (indices[ranked_indices], scores)
+            if self.use_ranking_cache:
+                structured_representation = self._normalize_sr(structured_representation)
+                self.ranking_cache.set(
+                    structured_representation,
+                    sources,
+                    evidence_pools[turn_index],
+                    rankings[turn_index],
+                )
+
+        return [
+            ranking_to_evidences(evidences, ranking)
+            for evidences, ranking in zip(evidence_pools, rankings)
+        ]
+
+    def prune(self, structured_representation, evidences, budget=None):
+        """
+        First-stage pruning: keep the candidates with the highest term overlap
+        with the SR, such that at most `budget` candidates are scored with BM25.
+        Ties are broken by position. Returns the (sorted) indices of the kept evidences,
+        and their term-frequency matrix for re-use in BM25 scoring
+        (None if no pruning was required).
+        """
+        if budget is None:
+            budget = self.prune_budget
+        if not budget or len(evidences) <= budget:
+            return np.arange(len(evidences)), None
+        tf_matrix = self.evs.get_tf_matrix(evidences)
+        term_overlaps = self.evs.get_term_overlaps(structured_representation, tf_matrix)
+        kept_indices = np.sort(top_k_indices(term_overlaps, budget))
+        return kept_indices, tf_matrix[kept_indices]
+
+    def _lookup_ranking(self, structured_representation, sources, evidences):
+        """Look-up ranking for the given SR (and retrieved evidences) in the ranking cache."""
+        if not self.use_ranking_cache:
+            return None
+        return self.ranking_cache.get(
+            self._normalize_sr(structured_representation),
+            sources,
+            self.evr.retriever_version(),
+            evidences,
+        )
+
+    def _normalize_sr(self, structured_representation):
+        """Normalize SR (as used for look-ups in ER cache)."""
+        return structured_representation.replace(self.evr.sr_delimiter, " ")
+
+    def evaluate_pruning(self, input_path, output_path, sources):
+        """
+        Compare the top evidences obtained with and without first-stage pruning
+        on the given data split. Recall@k is the fraction of the top-k evidences
+        of full BM25 scoring that are also retrieved after pruning.
+        """
+        with open(input_path, "r") as fp:
+            data = json.load(fp)
+        self.logger.info(f"Input data loaded from: {input_path}.")
+        input_turns = [turn for conversation in data for turn in conversation["questions"]]
+
+        max_evidences = self.evs.max_evidences
+        recalls = list()
+        pool_sizes = list()
+        pruned_pool_sizes = list()
+        full_answer_presences = list()
+        pruned_answer_presences = list()
+        for turn in tqdm(input_turns):
+            structured_representation = turn["structured_representation"]
+            evidences, _ = self.evr.retrieve_evidences(structured_representation, sources)
+            kept_indices, pruned_tf_matrix = self.prune(structured_representation, evidences)
+            pruned_evidences = [evidences[index] for index in kept_indices]
+
+            # score full and pruned pool
+            full_top_evidences, pruned_top_evidences = self.evs.get_top_evidences_batch(
+                [structured_representation] * 2,
+                [evidences, pruned_evidences],
+                [None, pruned_tf_matrix],
+            )
+            full_ids = set(
+                _evidence_id(evidence) for evidence in full_top_evidences[:max_evidences]
+            )
+            pruned_ids = set(
+                _evidence_id(evidence) for evidence in pruned_top_evidences[:max_evidences]
+            )
+            if full_ids:
+                recalls.append(len(full_ids & pruned_ids) / len(full_ids))
+            pool_sizes.append(len(evidences))
+            pruned_pool_sizes.append(len(pruned_evidences))
+            full_answer_presences.append(
+                answer_presence(full_top_evidences[:max_evidences], turn["answers"])[0]
+            )
+            pruned_answer_presences.append(
+                answer_presence(pruned_top_evidences[:max_evidences], turn["answers"])[0]
+            )
+
+        # write results
+        num_turns = max(len(input_turns), 1)
+        avg_recall = sum(recalls) / max(len(recalls), 1)
+        Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
+        with open(output_path, "w") as fp:
+            fp.write(f"Prune budget: {self.prune_budget}\n")
+            fp.write(f"Recall@{max_evidences}: {avg_recall}\n")
+            fp.write(f"Avg. candidates (full): {sum(pool_sizes) / num_turns}\n")
+            fp.write(f"Avg. candidates (pruned): {sum(pruned_pool_sizes) / num_turns}\n")
+            fp.write(f"Avg. answer presence (full): {sum(full_answer_presences) / num_turns}\n")
+            fp.write(f"Avg. answer presence (pruned): {sum(pruned_answer_presences) / num_turns}")
+        self.logger.info(f"Pruning evaluation written to: {output_path}.")
+
     def store_cache(self):
-        """Store cache of evidence retriever."""
+        """Store cache of evidence retriever, index of evidence scorer and ranking cache."""
         self.evr.store_cache()
+        self.evs.store_index()
+        if self.use_ranking_cache:
+            # rankings are stored for the updated version of the ER cache
+            self.ranking_cache.store(self.evr.retriever_version())
+
+
+def _evidence_id(evidence):
+    """Identify evidence by its text and the entity it was retrieved for."""
+    return (evidence["evidence_text"], evidence["retrieved_for_entity"]["id"])
 
 
 #######################################################################################################################
 #######################################################################################################################
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        raise Exception("python convinse/evidence_retrieval_scoring/clocq_bm25.py <PATH_TO_CONFIG>")
+    if not len(sys.argv) in [2, 3]:
+        raise Exception(
+            "python convinse/evidence_retrieval_scoring/clocq_bm25.py [--evaluate-pruning] <PATH_TO_CONFIG>"
+        )
 
     # load config
-    config_path = sys.argv[1]
+    config_path = sys.argv[-1]
     config = get_config(config_path)
     ers = ClocqBM25(config)
 
@@ -51,26 +235,42 @@ if __name__ == "__main__":
     qu = config["qu"]
     source_combinations = config["source_combinations"]
 
-    for sources in source_combinations:
-        sources_string = "_".join(sources)
-
-        input_path = os.path.join(input_dir, qu, "train_qu.json")
-        if os.path.exists(input_path):
+    # recall of first-stage pruning on dev set
+    if len(sys.argv) == 3:
+        if sys.argv[1] != "--evaluate-pruning":
+            raise Exception(f"Unknown function {sys.argv[1]}!")
+        for sources in source_combinations:
+            sources_string = "_".join(sources)
+            input_path = os.path.join(input_dir, qu, "dev_qu.json")
             output_path = os.path.join(
-                output_dir, qu, "clocq_bm25", sources_string, "train_ers.jsonl"
+                output_dir, qu, "clocq_bm25", sources_string, "dev_pruning.res"
             )
-            ers.inference_on_data_split(input_path, output_path, sources)
+            ers.evaluate_pruning(input_path, output_path, sources)
+
+    # inference on all data splits
+    else:
+        for sources in source_combinations:
+            sources_string = "_".join(sources)
 
-        input_path = os.path.join(input_dir, qu, "dev_qu.json")
-        if os.path.exists(input_path):
+            input_path = os.path.join(input_dir, qu, "train_qu.json")
+            if os.path.exists(input_path):
+                output_path = os.path.join(
+                    output_dir, qu, "clocq_bm25", sources_string, "train_ers.jsonl"
+                )
+                ers.inference_on_data_split(input_path, output_path, sources)
+
+            input_path = os.path.join(input_dir, qu, "dev_qu.json")
+            if os.path.exists(input_path):
+                output_path = os.path.join(
+                    output_dir, qu, "clocq_bm25", sources_string, "dev_ers.jsonl"
+                )
+                ers.inference_on_data_split(input_path, output_path, sources)
+
+            input_path = os.path.join(input_dir, qu, "test_qu.json")
             output_path = os.path.join(
-                output_dir, qu, "clocq_bm25", sources_string, "dev_ers.jsonl"
+                output_dir, qu, "clocq_bm25", sources_string, "test_ers.jsonl"
             )
             ers.inference_on_data_split(input_path, output_path, sources)
 
-        input_path = os.path.join(input_dir, qu, "test_qu.json")
-        output_path = os.path.join(output_dir, qu, "clocq_bm25", sources_string, "test_ers.jsonl")
-        ers.inference_on_data_split(input_path, output_path, sources)
-
     # store results in cache
     ers.store_cache()
@@ -5,6 +5,7 @@ import time
 import pickle
 import logging
 from pathlib import Path
+from collections import Counter
 from filelock import FileLock
 
 from clocq.CLOCQ import CLOCQ
@@ -39,6 +40,12 @@ class ClocqRetriever:
 		else:
 			self.clocq = CLOCQ()
 
+		# candidate budgets (0: no limit), and counters for how often each budget was hit
+		self.max_candidates_per_entity = config["evr_max_candidates_per_entity"]
+		self.max_candidates_per_source = config["evr_max_candidates_per_source"]
+		self.max_candidates_per_turn = config["evr_max_candidates_per_turn"]
+		self.budget_hits = Counter()
+
 		# initialize wikipedia-retriever
 		self.wiki_retriever = WikipediaRetriever(config)
 		if config["qu"] == "sr":
@@ -83,11 +90,11 @@ class ClocqRetriever:
 
 		# wikipedia evidences (only if required)
 		if any(src in sources for src in ["text", "table", "info"]):
-			for question_entity in all_question_entities:
-				all_evidences += self.retrieve_wikipedia_evidences(question_entity)
+			all_evidences += self.retrieve_wikipedia_evidences_batch(all_question_entities)
 
 		# config-based filtering
 		all_evidences = self.filter_evidences(all_evidences, sources)
+		all_evidences = self.apply_budgets(all_evidences)
 		return all_evidences, all_question_entities
 
 	def retrieve_wikipedia_evidences(self, question_entity):
@@ -120,6 +127,22 @@ class ClocqRetriever:
 			# self.cache["wikipedia"][question_entity_id] = evidences
 		return evidences
 
+	def retrieve_wikipedia_evidences_batch(self, question_entities):
+		"""
+		Retrieve evidences from Wikipedia for the given question entities.
+		Pages missing in the Wikipedia dump are processed in one batch.
+		"""
+		question_entity_ids = [question_entity["item"]["id"] for question_entity in question_entities]
+		entity_to_evidences = self.wiki_retriever.retrieve_wp_evidences_batch(question_entity_ids)
+
+		all_evidences = list()
+		for question_entity in question_entities:
+			evidences = entity_to_evidences[question_entity["item"]["id"]]
+			for evidence in evidences:
+				evidence["retrieved_for_entity"] = question_entity["item"]
+			all_evidences += evidences
+		return all_evidences
+
 	def retrieve_KB_facts(self, structured_representation):
 		"""
 		Retrieve KB facts for the given SR (or other question/text).
@@ -213,6 +236,60 @@ class ClocqRetriever:
 
 		return filtered_evidences
 
+	def apply_budgets(self, evidences):
+		"""
+		Limit the number of candidates per entity (the evidence was retrieved for),
+		per source and per turn. Budgets are shared fairly: candidates are selected
+		round-robin over the (entity, source) groups, such that each entity gets its
+		share of each source, and no source is starved by the candidates of another.
+		Within a group, evidences are taken in the order they were generated.
+		Selected evidences keep their original order.
+		"""
+		self.budget_hits["retrievals"] += 1
+		if not (self.max_candidates_per_entity or self.max_candidates_per_source or self.max_candidates_per_turn):
+			return evidences
+
+		# group evidences by entity and source (groups in order of first occurrence)
+		groups = dict()
+		for index, evidence in enumerate(evidences):
+			entity_id = evidence["retrieved_for_entity"]["id"] if evidence.get("retrieved_for_entity") else None
+			groups.setdefault((entity_id, evidence["source"]), list()).append(index)
+
+		# round-robin over groups, until groups are exhausted or budgets are hit
+		entity_counts = Counter()
+		source_counts = Counter()
+		budget_hit = {"entity": False, "source": False, "turn": False}
+		selected_indices = list()
+		active_groups = list(groups.items())
+		position = 0
+		while active_groups and not budget_hit["turn"]:
+			remaining_groups = list()
+			for (entity_id, source), indices in active_groups:
+				if self.max_candidates_per_turn and len(selected_indices) >= self.max_candidates_per_turn:
+					budget_hit["turn"] = True
+					break
+				if self.max_candidates_per_entity and entity_counts[entity_id] >= self.max_candidates_per_entity:
+					budget_hit["entity"] = True
+					continue
+				if self.max_candidates_per_source and source_counts[source] >= self.max_candidates_per_source:
+					budget_hit["source"] = True
+					continue
+				entity_counts[entity_id] += 1
+				source_counts[source] += 1
+				selected_indices.append(indices[position])
+				if position + 1 < len(indices):
+					remaining_groups.append(((entity_id, source), indices))
+			active_groups = remaining_groups
+			position += 1
+
+		# remember how often each budget was hit
+		self.budget_hits.update([budget for budget, hit in budget_hit.items() if hit])
+		return [evidences[index] for index in sorted(selected_indices)]
+
+	def log_budget_hits(self):
+		"""Log how often the candidate budgets were hit (number of retrievals)."""
+		self.logger.info(f"Candidate budgets hit: {dict(self.budget_hits)}.")
+
 	def _kb_fact_to_text(self, fact):
 		"""Verbalize the KB-fact."""
 		return KB_ITEM_SEPARATOR.join([item["label"] for item in fact])
@@ -242,9 +319,14 @@ class ClocqRetriever:
 				# store
 				self._write_cache(updated_cache)
 				self._write_cache_version()
+		self.cache_changed = False
 		# store extended wikipedia dump (if any changes occured)
 		self.wiki_retriever.store_dump()
 
+	def retriever_version(self):
+		"""Version of the retrieval results: version of the ER cache and size of the Wikipedia dump."""
+		return (self.cache_version, len(self.wiki_retriever.wikipedia_dump))
+
 	def reset_cache(self):
 		"""Reset the cache for new population."""
 		self.logger.warn(f"Resetting ER cache at path {self.cache_path}.")
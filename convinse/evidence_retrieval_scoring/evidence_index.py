@@ -0,0 +1,176 @@
+import os
+import pickle
+import numpy as np
+
+from pathlib import Path
+from filelock import FileLock
+from scipy import sparse
+
+from convinse.library.utils import get_logger
+
+
+class EvidenceIndex:
+    """
+    Persistent index of pre-tokenized evidences, stored alongside the ER cache.
+    Evidences are organized in per-entity blocks (the entity they were retrieved for),
+    and each block holds the postings (token IDs and term frequencies) of its evidences
+    in CSR format.
+    Document lengths are given by the sums of the term frequencies.
+    Evidences are only tokenized once, when they are first seen for the entity.
+    """
+
+    def __init__(self, config, tokenize):
+        self.config = config
+        self.logger = get_logger(__name__, config)
+        self.index_path = config["evs_index_path"]
+        self.tokenize = tokenize
+
+        # initialize index
+        self._init_index()
+        self.changed_blocks = set()
+
+    def get_tf_matrix(self, evidences):
+        """
+        Assemble the term-frequency matrix (evidences x token IDs) for the given evidences,
+        by concatenating the rows of the corresponding entity blocks.
+        Evidences missing in the index are tokenized and added to their block.
+        """
+        # group evidences by block
+        block_rows = dict()
+        for position, evidence in enumerate(evidences):
+            block_key = self.block_key(evidence)
+            positions, texts = block_rows.setdefault(block_key, (list(), list()))
+            positions.append(position)
+            texts.append(evidence["evidence_text"])
+
+        # add missing evidences first, such that all blocks are read with the final vocabulary
+        for block_key, (positions, texts) in block_rows.items():
+            block = self.blocks.get(block_key)
+            if block is None or any(not text in block["rows"] for text in texts):
+                self._extend_block(block_key, texts)
+
+        # collect rows from blocks
+        matrices = list()
+        all_positions = list()
+        for block_key, (positions, texts) in block_rows.items():
+            block = self.blocks[block_key]
+            rows = [block["rows"][text] for text in texts]
+            matrices.append(self._block_matrix(block)[rows])
+            all_positions += positions
+
+        # concatenate blocks, and restore the order of the evidences
+        tf_matrix = sparse.vstack(matrices, format="csr")
+        order = np.empty(len(all_positions), dtype=np.int64)
+        order[np.array(all_positions, dtype=np.int64)] = np.arange(len(all_positions))
+        return tf_matrix[order]
+
+    def block_key(self, evidence):
+        """Key of the block the evidence belongs to (ID of the entity it was retrieved for)."""
+        retrieved_for_entity = evidence.get("retrieved_for_entity")
+        if not retrieved_for_entity:
+            return None
+        return retrieved_for_entity["id"]
+
+    def _block_matrix(self, block):
+        """Term-frequency matrix (in the space of all token IDs) of the given block."""
+        return sparse.csr_matrix(
+            (block["tfs"], block["term_ids"], block["indptr"]),
+            shape=(len(block["indptr"]) - 1, len(self.vocabulary)),
+        )
+
+    def _extend_block(self, block_key, texts):
+        """Tokenize the given evidence texts (if not in the block yet) and add them to the block."""
+        block = self.blocks.get(block_key)
+        if block is None:
+            block = {
+                "rows": dict(),
+                "indptr": np.zeros(1, dtype=np.int64),
+                "term_ids": np.zeros(0, dtype=np.int32),
+                "tfs": np.zeros(0, dtype=np.int32),
+            }
+
+        # tokenize new evidences
+        new_texts = list()
+        indptr = [0]
+        term_ids = list()
+        for text in texts:
+            if text in block["rows"]:
+                continue
+            block["rows"][text] = len(block["indptr"]) - 1 + len(new_texts)
+            new_texts.append(text)
+            for token in self.tokenize(text):
+                term_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+            indptr.append(len(term_ids))
+
+        # term frequencies (duplicate token IDs within an evidence are summed up)
+        tf_matrix = sparse.csr_matrix(
+            (np.ones(len(term_ids), dtype=np.int32), np.array(term_ids, dtype=np.int32), indptr),
+            shape=(len(new_texts), len(self.vocabulary)),
+        )
+        tf_matrix.sum_duplicates()
+
+        # append to block
+        block["indptr"] = np.concatenate(
+            [block["indptr"], tf_matrix.indptr[1:].astype(np.int64) + block["indptr"][-1]]
+        )
+        block["term_ids"] = np.concatenate([block["term_ids"], tf_matrix.indices.astype(np.int32)])
+        block["tfs"] = np.concatenate([block["tfs"], tf_matrix.data.astype(np.int32)])
+        self.blocks[block_key] = block
+        self.changed_blocks.add(block_key)
+        return block
+
+    def store(self):
+        """
+        Store the index to disk. Blocks changed by this process are merged into
+        the current version on disk (token IDs are mapped to the vocabulary on disk).
+        """
+        if not self.changed_blocks:
+            return
+        self.logger.info(f"Writing evidence index at path {self.index_path}.")
+        with FileLock(f"{self.index_path}.lock"):
+            index = self._read_index()
+            stored_vocabulary = {
+                token: token_id for token_id, token in enumerate(index["vocabulary"])
+            }
+
+            # map token IDs of this process to the stored vocabulary
+            tokens = [None] * len(self.vocabulary)
+            for token, token_id in self.vocabulary.items():
+                tokens[token_id] = token
+            id_mapping = np.array(
+                [stored_vocabulary.setdefault(token, len(stored_vocabulary)) for token in tokens],
+                dtype=np.int32,
+            )
+
+            # overwrite changed blocks
+            for block_key in self.changed_blocks:
+                block = dict(self.blocks[block_key])
+                block["term_ids"] = id_mapping[block["term_ids"]]
+                index["blocks"][block_key] = block
+
+            index["vocabulary"] = list(stored_vocabulary.keys())
+            self._write_index(index)
+        self.changed_blocks = set()
+
+    def _init_index(self):
+        """Initialize the index."""
+        Path(os.path.dirname(self.index_path)).mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.index_path}.lock"):
+            index = self._read_index()
+        self.vocabulary = {token: token_id for token_id, token in enumerate(index["vocabulary"])}
+        self.blocks = index["blocks"]
+        self.logger.info(f"Evidence index loaded with {len(self.blocks)} blocks.")
+
+    def _read_index(self):
+        """Read the current version of the index."""
+        if not os.path.isfile(self.index_path):
+            return {"vocabulary": list(), "blocks": dict()}
+        with open(self.index_path, "rb") as fp:
+            return pickle.load(fp)
+
+    def _write_index(self, index):
+        """Write the index."""
+        index_dir = os.path.dirname(self.index_path)
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+        with open(self.index_path, "wb") as fp:
+            pickle.dump(index, fp)
@@ -5,7 +5,10 @@ from pathlib import Path
 from tqdm import tqdm
 
 from convinse.library.utils import get_config, get_logger
-from convinse.evaluation import answer_presence
+from convinse.evaluation import answer_presence, evidence_has_answer
+
+# cut-offs for which answer presence is reported (as prefixes of the ranking)
+ANSWER_PRESENCE_KS = [1, 5, 10, 20, 50, 100, 200, 500, 1000]
 
 
 class EvidenceRetrievalScoring:
@@ -65,26 +68,19 @@ class EvidenceRetrievalScoring:
 
         # score
         answer_presences = list()
+        answer_ranks = list()
         source_to_ans_pres = {"kb": 0, "text": 0, "table": 0, "info": 0, "all": 0}
 
         # create folder if not exists
         output_dir = os.path.dirname(output_path)
         Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-        # process data
-        with open(output_path, "w") as fp:
-            for conversation in tqdm(data):
-                for turn in conversation["questions"]:
-                    top_evidences = self.inference_on_turn(turn, sources)
-                    turn["top_evidences"] = top_evidences
-
-                    # answer presence
-                    hit, answering_evidences = answer_presence(top_evidences, turn["answers"])
-                    turn["answer_presence"] = hit
-                    turn["answer_presence_per_src"] = {
-                        evidence["source"]: 1 for evidence in answering_evidences
-                    }
+        # process data (all turns are passed at once, to allow for batched scoring in chunks)
+        input_turns = [turn for conversation in data for turn in conversation["questions"]]
+        self.inference_on_turns(input_turns, sources)
 
+        with open(output_path, "w") as fp:
+            for conversation in data:
                 # write conversation to file
                 fp.write(json.dumps(conversation))
                 fp.write("\n")
@@ -92,6 +88,9 @@ class EvidenceRetrievalScoring:
                 # accumulate results
                 c_answer_presences = [turn["answer_presence"] for turn in conversation["questions"]]
                 answer_presences += c_answer_presences
+                answer_ranks += [
+                    self._first_answer_rank(turn) for turn in conversation["questions"]
+                ]
                 for turn in conversation["questions"]:
                     answer_presence_per_src = turn["answer_presence_per_src"]
                     # add per source answer presence
@@ -109,7 +108,16 @@ class EvidenceRetrievalScoring:
             answer_presence_per_src = {
                 src: (num / len(answer_presences)) for src, num in source_to_ans_pres.items()
             }
-            fp.write(f"Answer presence per source: {answer_presence_per_src}")
+            fp.write(f"Answer presence per source: {answer_presence_per_src}\n")
+            # answer presence for smaller/larger k (prefixes of the stored ranking)
+            max_ranked = max([len(turn["top_evidences"]) for turn in input_turns] + [0])
+            answer_presence_at_k = {
+                k: sum(1 for rank in answer_ranks if not rank is None and rank <= k)
+                / len(answer_ranks)
+                for k in ANSWER_PRESENCE_KS
+                if k <= max_ranked
+            }
+            fp.write(f"Answer presence at k: {answer_presence_at_k}")
 
         # log
         self.logger.info(f"Done with processing: {input_path}.")
@@ -122,18 +130,33 @@ class EvidenceRetrievalScoring:
 
     def inference_on_turns(self, input_turns, sources=["kb", "text", "table", "info"]):
         """Run ERS on given turns."""
-        for turn in input_turns:
+        for turn in tqdm(input_turns):
             top_evidences = self.inference_on_turn(turn, sources)
-            turn["top_evidences"] = top_evidences
-
-            # answer presence
-            hit, answering_evidences = answer_presence(top_evidences, turn["answers"])
-            turn["answer_presence"] = hit
-            turn["answer_presence_per_src"] = {
-                evidence["source"]: 1 for evidence in answering_evidences
-            }
+            self.set_top_evidences(turn, top_evidences)
         return input_turns
 
+    def set_top_evidences(self, turn, top_evidences):
+        """
+        Store the ranked evidences in the turn, and compute answer presence
+        for the top-e evidences (prefix of the ranking).
+        """
+        turn["top_evidences"] = top_evidences
+
+        # answer presence
+        top_evidences = top_evidences[: self.config["evs_max_evidences"]]
+        hit, answering_evidences = answer_presence(top_evidences, turn["answers"])
+        turn["answer_presence"] = hit
+        turn["answer_presence_per_src"] = {
+            evidence["source"]: 1 for evidence in answering_evidences
+        }
+
+    def _first_answer_rank(self, turn):
+        """Rank of the first answering evidence in the ranking (None if no answer is found)."""
+        for rank, evidence in enumerate(turn["top_evidences"], start=1):
+            if evidence_has_answer(evidence, turn["answers"]):
+                return rank
+        return None
+
     def inference_on_turn(self):
         raise Exception(
             "This is an abstract function which should be overwritten in a derived class!"
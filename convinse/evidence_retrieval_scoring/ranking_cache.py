@@ -0,0 +1,124 @@
+import os
+import json
+import pickle
+import hashlib
+
+from pathlib import Path
+from filelock import FileLock
+
+from convinse.library.utils import get_logger
+from convinse.evidence_retrieval_scoring.bm25_es import pool_hash
+
+# config parameters that affect the retrieved evidences or their ranking
+RANKING_CONFIG_KEYS = [
+    "qu",
+    "sr_delimiter",
+    "path_to_stopwords",
+    "clocq_params",
+    "clocq_p",
+    "evr_min_evidence_length",
+    "evr_max_evidence_length",
+    "evr_max_entities",
+    "evr_max_table_rows_per_page",
+    "evr_sentence_splitter",
+    "evr_max_candidates_per_entity",
+    "evr_max_candidates_per_source",
+    "evr_max_candidates_per_turn",
+    "evs_prune_budget",
+    "evs_max_ranked_evidences",
+]
+
+
+class RankingCache:
+    """
+    Persistent cache of evidence rankings, keyed by (SR, sources, config hash).
+    A ranking is stored as the ranked indices into the retrieved evidences,
+    together with their scores, and the size and hash of the retrieved pool.
+    Each entry remembers the retriever version (ER cache version and size of
+    the Wikipedia dump) it was computed for. On a look-up, the entry is only
+    used if the pool has the same size, and (for other retriever versions)
+    the same hash, such that the indices point to the same evidences.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = get_logger(__name__, config)
+        self.cache_path = config["evs_ranking_cache_path"]
+        self.config_hash = self._config_hash(config)
+
+        # initialize cache: (sr, sources, config_hash) -> (retriever_version, pool_info, ranking)
+        self._init_cache()
+        # rankings computed by this process: (sr, sources, config_hash) -> (pool_info, ranking)
+        self.new_rankings = dict()
+
+    def get(self, structured_representation, sources, retriever_version, evidences):
+        """
+        Look-up the ranking for the given SR and sources (None if not cached),
+        given the evidences retrieved with the current retriever version.
+        """
+        key = self._key(structured_representation, sources)
+        if key in self.new_rankings:
+            (pool_size, _), ranking = self.new_rankings[key]
+            return ranking if pool_size == len(evidences) else None
+        entry = self.rankings.get(key)
+        if entry is None:
+            return None
+        version, (pool_size, stored_pool_hash), ranking = entry
+        if pool_size != len(evidences):
+            return None
+        if version != retriever_version and stored_pool_hash != pool_hash(evidences):
+            return None
+        return ranking
+
+    def set(self, structured_representation, sources, evidences, ranking):
+        """Remember the ranking computed for the given SR and (retrieved) evidences."""
+        key = self._key(structured_representation, sources)
+        pool_info = (len(evidences), pool_hash(evidences))
+        self.new_rankings[key] = (pool_info, ranking)
+
+    def store(self, retriever_version):
+        """
+        Store the cache to disk (merged with updates of other processes).
+        New rankings are stored for the given (updated) retriever version.
+        Rankings for older versions are kept, since the retriever caches
+        are only extended (validity is checked on look-up).
+        """
+        if not self.new_rankings:
+            return
+        self.logger.info(f"Writing ranking cache at path {self.cache_path}.")
+        with FileLock(f"{self.cache_path}.lock"):
+            rankings = self._read_cache()
+            for key, (pool_info, ranking) in self.new_rankings.items():
+                rankings[key] = (retriever_version, pool_info, ranking)
+            self._write_cache(rankings)
+        self.rankings = rankings
+        self.new_rankings = dict()
+
+    def _key(self, structured_representation, sources):
+        return (structured_representation, tuple(sorted(sources)), self.config_hash)
+
+    def _config_hash(self, config):
+        """Hash of the config parameters the rankings depend on."""
+        values = json.dumps([config[key] for key in RANKING_CONFIG_KEYS])
+        return hashlib.md5(values.encode("utf-8")).hexdigest()
+
+    def _init_cache(self):
+        """Initialize the cache."""
+        Path(os.path.dirname(self.cache_path)).mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.cache_path}.lock"):
+            self.rankings = self._read_cache()
+        self.logger.info(f"Ranking cache loaded with {len(self.rankings)} rankings.")
+
+    def _read_cache(self):
+        """Read the current version of the cache."""
+        if not os.path.isfile(self.cache_path):
+            return dict()
+        with open(self.cache_path, "rb") as fp:
+            return pickle.load(fp)
+
+    def _write_cache(self, rankings):
+        """Write to the cache."""
+        cache_dir = os.path.dirname(self.cache_path)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, "wb") as fp:
+            pickle.dump(rankings, fp)
@@ -0,0 +1,42 @@
+import random
+import numpy as np
+import pytest
+
+from convinse.evidence_retrieval_scoring.bm25_es import BM25Index, top_k_indices
+
+rank_bm25 = pytest.importorskip("rank_bm25")
+
+
+def _random_corpus(seed, num_docs=50, vocabulary_size=30):
+    random.seed(seed)
+    vocabulary = [f"w{i}" for i in range(vocabulary_size)]
+    # frequent terms (in most documents) get negative idfs
+    return [
+        ["w0", "w1"] + [random.choice(vocabulary) for _ in range(random.randint(0, 20))]
+        for _ in range(num_docs)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_scores_match_rank_bm25(seed):
+    corpus = _random_corpus(seed)
+    index = BM25Index.from_tokenized_corpus(corpus)
+    reference = rank_bm25.BM25Okapi(corpus)
+    for query in [["w0"], ["w2", "w3", "w3"], ["w1", "w5", "unknown"], ["unknown"], []]:
+        assert np.allclose(index.get_scores(query), reference.get_scores(query))
+
+
+def test_batch_scores_match_single_scores():
+    corpus = _random_corpus(0)
+    index = BM25Index.from_tokenized_corpus(corpus)
+    queries = [["w0"], ["w2", "w3"], ["unknown"]]
+    scores = index.get_scores_batch(queries)
+    assert scores.shape == (len(corpus), len(queries))
+    for column, query in enumerate(queries):
+        assert np.allclose(scores[:, column], index.get_scores(query))
+
+
+def test_top_k_indices_breaks_ties_by_index():
+    scores = np.array([1.0, 3.0, 2.0, 3.0, 1.0, 2.0])
+    assert list(top_k_indices(scores, 3)) == [1, 3, 2]
+    assert list(top_k_indices(scores, 10)) == list(np.argsort(-scores, kind="stable"))
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from convinse.evidence_retrieval_scoring.evidence_index import EvidenceIndex
+
+
+def _evidence(text, entity_id):
+    return {"evidence_text": text, "retrieved_for_entity": {"id": entity_id, "label": entity_id}}
+
+
+def _dense_tf(tf_matrix, vocabulary, texts):
+    """Term-frequency rows as dicts (token -> tf), independent of the token IDs."""
+    tokens = {token_id: token for token, token_id in vocabulary.items()}
+    rows = list()
+    for row in tf_matrix.toarray()[: len(texts)]:
+        rows.append({tokens[token_id]: tf for token_id, tf in enumerate(row) if tf})
+    return rows
+
+
+def _expected_tf(text):
+    tf = dict()
+    for token in text.split():
+        tf[token] = tf.get(token, 0) + 1
+    return tf
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {"log_level": "WARNING", "evs_index_path": str(tmp_path / "index" / "evs_index.pickle")}
+
+
+def test_tf_matrix_keeps_order_of_evidences(config):
+    index = EvidenceIndex(config, str.split)
+    evidences = [
+        _evidence("a b b", "Q1"),
+        _evidence("c d", "Q2"),
+        _evidence("a c c c", "Q1"),
+        _evidence("b", None),
+    ]
+    tf_matrix = index.get_tf_matrix(evidences)
+    texts = [evidence["evidence_text"] for evidence in evidences]
+    assert tf_matrix.shape[0] == len(evidences)
+    expected_tfs = [_expected_tf(text) for text in texts]
+    assert _dense_tf(tf_matrix, index.vocabulary, texts) == expected_tfs
+
+
+def test_evidences_are_tokenized_once(config):
+    tokenized = list()
+
+    def tokenize(text):
+        tokenized.append(text)
+        return text.split()
+
+    index = EvidenceIndex(config, tokenize)
+    index.get_tf_matrix([_evidence("a b", "Q1"), _evidence("c", "Q1")])
+    index.get_tf_matrix([_evidence("c", "Q1"), _evidence("a b", "Q1"), _evidence("d", "Q1")])
+    assert tokenized == ["a b", "c", "d"]
+
+
+def test_store_merges_vocabularies_of_processes(config):
+    # two processes extend the index with different vocabularies
+    first = EvidenceIndex(config, str.split)
+    second = EvidenceIndex(config, str.split)
+    first.get_tf_matrix([_evidence("a b", "Q1")])
+    second.get_tf_matrix([_evidence("c a", "Q2"), _evidence("d", "Q2")])
+    first.store()
+    second.store()
+
+    # token IDs of the second process are mapped to the stored vocabulary
+    reloaded = EvidenceIndex(config, lambda text: pytest.fail("evidence tokenized again"))
+    evidences = [_evidence("d", "Q2"), _evidence("a b", "Q1"), _evidence("c a", "Q2")]
+    tf_matrix = reloaded.get_tf_matrix(evidences)
+    texts = [evidence["evidence_text"] for evidence in evidences]
+    expected_tfs = [_expected_tf(text) for text in texts]
+    assert _dense_tf(tf_matrix, reloaded.vocabulary, texts) == expected_tfs
+    assert sorted(reloaded.vocabulary.values()) == list(range(len(reloaded.vocabulary)))
+    assert np.all(tf_matrix.sum(axis=1).A1 == [1, 2, 2])
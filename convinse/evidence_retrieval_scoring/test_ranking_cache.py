@@ -0,0 +1,127 @@
+import pytest
+
+from convinse.evidence_retrieval_scoring import clocq_bm25
+from convinse.evidence_retrieval_scoring.clocq_bm25 import ClocqBM25
+from convinse.evidence_retrieval_scoring.ranking_cache import RANKING_CONFIG_KEYS
+
+SOURCES = ["kb", "text"]
+
+
+class FakeRetriever:
+    """Retriever with a fixed pool of evidences per SR."""
+
+    pools = dict()
+    version = ("1", 0)
+
+    def __init__(self, config):
+        self.sr_delimiter = "||"
+
+    def retrieve_evidences(self, structured_representation, sources):
+        return self.pools[structured_representation], list()
+
+    def retriever_version(self):
+        return self.version
+
+    def log_budget_hits(self):
+        pass
+
+    def store_cache(self):
+        pass
+
+
+def _evidence(text, entity_id="Q1"):
+    return {"evidence_text": text, "retrieved_for_entity": {"id": entity_id}, "source": "text"}
+
+
+@pytest.fixture
+def config(tmp_path):
+    stopwords_path = tmp_path / "stopwords.txt"
+    stopwords_path.write_text("the\nof")
+    config = {key: None for key in RANKING_CONFIG_KEYS}
+    config.update(
+        {
+            "log_level": "WARNING",
+            "qu": "sr",
+            "sr_delimiter": "||",
+            "path_to_stopwords": str(stopwords_path),
+            "ers_use_cache": True,
+            "evs_use_ranking_cache": True,
+            "evs_ranking_cache_path": str(tmp_path / "ranking_cache.pickle"),
+            "evs_index_path": str(tmp_path / "evidence_index.pickle"),
+            "evs_max_evidences": 2,
+            "evs_max_ranked_evidences": 3,
+            "evs_prune_budget": 0,
+            "evs_batch_turns": 10,
+        }
+    )
+    return config
+
+
+@pytest.fixture
+def retriever(monkeypatch):
+    monkeypatch.setattr(clocq_bm25, "ClocqRetriever", FakeRetriever)
+    FakeRetriever.pools = {
+        "capital||france": [
+            _evidence("paris is the capital of france"),
+            _evidence("lyon is a city in france", "Q2"),
+            _evidence("berlin is the capital of germany"),
+            _evidence("france borders germany", "Q2"),
+        ],
+    }
+    FakeRetriever.version = ("1", 0)
+    return FakeRetriever
+
+
+def _rank(config, structured_representation="capital||france"):
+    ers = ClocqBM25(config)
+    turn = {"structured_representation": structured_representation}
+    top_evidences = ers.rank_evidences([turn], SOURCES)[0]
+    ers.store_cache()
+    return ers, top_evidences
+
+
+def _fail_scoring(monkeypatch):
+    def rank_batch(structured_representations, evidence_pools, tf_matrices=None):
+        assert not structured_representations, "ranking was not taken from the cache"
+        return list()
+
+    monkeypatch.setattr(clocq_bm25.BM25Scoring, "rank_batch", lambda self, *args: rank_batch(*args))
+
+
+def test_cache_hit_returns_same_evidences(config, retriever, monkeypatch):
+    _, fresh_top_evidences = _rank(config)
+    _fail_scoring(monkeypatch)
+    _, cached_top_evidences = _rank(config)
+    assert cached_top_evidences == fresh_top_evidences
+    assert len(cached_top_evidences) == 3
+
+
+def test_cache_hit_for_older_retriever_version_with_same_pool(config, retriever, monkeypatch):
+    _, fresh_top_evidences = _rank(config)
+    retriever.version = ("2", 10)
+    _fail_scoring(monkeypatch)
+    _, cached_top_evidences = _rank(config)
+    assert cached_top_evidences == fresh_top_evidences
+
+
+def test_changed_pool_is_ranked_again(config, retriever):
+    _rank(config)
+    # same size, but different evidences (e.g. Wikipedia dump changed)
+    retriever.pools["capital||france"][0] = _evidence("rome is the capital of italy")
+    retriever.version = ("1", 1)
+    _, top_evidences = _rank(config)
+    texts = [evidence["evidence_text"] for evidence in top_evidences]
+    assert not "paris is the capital of france" in texts
+
+    # more evidences than in the cached pool (same version)
+    retriever.pools["capital||france"].insert(0, _evidence("the capital of france is paris", "Q3"))
+    _, top_evidences = _rank(config)
+    assert top_evidences[0]["evidence_text"] == "the capital of france is paris"
+
+
+def test_store_keeps_rankings_of_older_versions(config, retriever):
+    retriever.pools["other||sr"] = [_evidence("some other evidence")]
+    _rank(config, "other||sr")
+    retriever.version = ("2", 0)
+    ers, _ = _rank(config)
+    assert len(ers.ranking_cache.rankings) == 2
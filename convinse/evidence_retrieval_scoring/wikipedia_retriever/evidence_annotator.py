@@ -1,12 +1,17 @@
 import os
 import re
-import json
 import pickle
 import logging
-import requests
 
+from pathlib import Path
+
+from convinse.library.aho_corasick import AhoCorasick
 from convinse.library.string_library import StringLibrary as string_lib
+from convinse.library.label_store import get_label_store
 import convinse.library.wikipedia_library as wiki
+from convinse.evidence_retrieval_scoring.wikipedia_retriever.redirect_resolver import (
+    RedirectResolver,
+)
 
 YEAR_PATTERN = re.compile("[0-9][0-9][0-9][0-9]")
 # dmy dates: https://en.wikipedia.org/wiki/Template:Use_dmy_dates
@@ -14,8 +19,6 @@ DMY_PATTERN = re.compile("[0-9]+ [A-Z][a-z]* [0-9][0-9][0-9][0-9]")
 # mdy dates: https://en.wikipedia.org/wiki/Template:Use_mdy_dates
 MDY_PATTERN = re.compile("[A-Z][a-z]* [0-9]+, [0-9][0-9][0-9][0-9]")
 
-MAX_WIKI_PATHS_PER_REQ = 50
-
 # supress warnings on parser errors
 logging.getLogger("wikitables").setLevel("ERROR")
 
@@ -29,9 +32,11 @@ class EvidenceAnnotator:
         self.config = config
         self.wikidata_mappings = wikidata_mappings
 
-        # open Wikidata labels
-        with open(config["path_to_labels"], "r") as fp:
-            self.labels_dict = json.load(fp)
+        # open Wikidata labels (shared label store)
+        self.labels_dict = get_label_store(config)
+
+        # initialize persistent redirects (Wikipedia API)
+        self.redirect_resolver = RedirectResolver(config)
 
         # initialize cache
         self.path = f"cache/cache_wikipedia_to_wikidata.pickle"
@@ -45,6 +50,17 @@ class EvidenceAnnotator:
         doc_anchor_tuples = [(key, value) for key, value in doc_anchor_dict.items()]
         doc_anchor_tuples = sorted(doc_anchor_tuples, key=lambda y: len(y[0]), reverse=True)
 
+        ## do not consider wiki_paths with hashtags
+        # hashtag indicates a paragraph on entity, rather than entity
+        doc_anchor_tuples = [
+            (anchor_text, anchor_path)
+            for anchor_text, anchor_path in doc_anchor_tuples
+            if not "#" in anchor_path
+        ]
+
+        # build matcher for all anchor texts once per page
+        anchor_matcher = AhoCorasick([anchor_text for anchor_text, _ in doc_anchor_tuples])
+
         # detect wikipedia entities and dates first
         new_evidences = list()
 
@@ -52,7 +68,7 @@ class EvidenceAnnotator:
             # detect wikipedia entities
             if not evidence.get("source") == "infobox":  # entities for infobox are already done
                 wiki_paths, disambiguations = self._detect_wikipedia_entities(
-                    wiki_path, evidence, doc_anchor_tuples
+                    wiki_path, evidence, doc_anchor_tuples, anchor_matcher
                 )
                 evidence["wikipedia_paths"] = wiki_paths
                 evidence["wp_disambiguations"] = disambiguations
@@ -102,46 +118,39 @@ class EvidenceAnnotator:
                 for item_id in evidence["wikidata_entities"]
             ]
 
-    def _detect_wikipedia_entities(self, wiki_path, evidence, doc_anchor_tuples):
+    def _detect_wikipedia_entities(self, wiki_path, evidence, doc_anchor_tuples, anchor_matcher):
         """
         Identify Wikipedia entities in the given evidence using
         the given anchor dict for the Wikipedia page.
         Longer matches would be checked first.
         """
-        # remember all anchor texts for prunings
-        finds = list()
         disambiguations = list()
         evidence_text = evidence["evidence_text"]
 
+        # search first occurrence of each anchor text (in a single scan)
+        first_finds = dict()
+        for start, end, anchor_index in anchor_matcher.iter_matches(evidence_text):
+            if not anchor_index in first_finds:
+                first_finds[anchor_index] = (start, end)
+
+        # remember positions of all finds for prunings
+        occupied = bytearray(len(evidence_text) + 1)
+
+        # anchor texts are sorted by length -> longer matches first
         wikipedia_paths = list()
-        for anchor_text, anchor_path in doc_anchor_tuples:
-            if anchor_text in evidence_text:
-                ## do not consider wiki_paths with hashtags
-                # hashtag indicates a paragraph on entity, rather than entity
-                if "#" in anchor_path:
-                    continue
-
-                # search start and end points
-                new_start = evidence_text.find(anchor_text)
-                new_end = new_start + len(anchor_text)
-
-                ## detect duplicate match for substring
-                # positions must be inside range of [_start,_end]
-                # since anchor texts are sorted by length
-                duplicate = False
-                for _start, _end in finds:
-                    if new_start >= _start and new_start <= _end:
-                        duplicate = True
-                    elif new_end >= _start and new_end <= _end:
-                        duplicate = True
-
-                # if no duplicate match found -> new anchor
-                if not duplicate:
-                    finds.append((new_start, new_end))
-                    wikipedia_paths.append(anchor_path)
-                    disambiguations.append((anchor_text, anchor_path))
-                    # print(f"{anchor_text} ||| {anchor_path} ||| {evidence_text}")
-                    # print("\n")
+        for anchor_index in sorted(first_finds):
+            new_start, new_end = first_finds[anchor_index]
+
+            ## detect duplicate match for substring
+            # positions must be inside range of [_start,_end] of a previous find
+            if occupied[new_start] or occupied[new_end]:
+                continue
+
+            # no duplicate match found -> new anchor
+            occupied[new_start : new_end + 1] = b"\x01" * (new_end - new_start + 1)
+            anchor_text, anchor_path = doc_anchor_tuples[anchor_index]
+            wikipedia_paths.append(anchor_path)
+            disambiguations.append((anchor_text, anchor_path))
 
         # add path of Wikipedia page entity
         if not wiki_path in wikipedia_paths:
@@ -196,8 +205,10 @@ class EvidenceAnnotator:
         """
         Transform the given Wikipedia path to the Wikidata ID.
         """
-        if self.cache.get(wiki_path):
+        # cache also holds paths that could not be translated (False)
+        if wiki_path in self.cache:
             return self.cache[wiki_path]
+        original_wiki_path = wiki_path
 
         # try look-up
         if self.wikidata_mappings.get(wiki_path):
@@ -217,94 +228,47 @@ class EvidenceAnnotator:
         else:
             return None
 
-        self.cache[wiki_path] = wikidata_id
+        self.cache[original_wiki_path] = wikidata_id
+        self.cache_changed = True
         return wikidata_id
 
     def extract_redirects(self, wiki_paths):
         """
         Extract redirects for set of Wikipedia paths (one entity can have multiple paths).
-        Makes use of _extract_redirects_for_50 function to decrease number
-        of requests required.
+        Redirects are looked up in the persistent store of the RedirectResolver,
+        and only unknown paths are requested from the Wikipedia API.
         """
+        wiki_paths = self._drop_known_wiki_paths(wiki_paths)
+        return self.redirect_resolver.resolve(wiki_paths)
 
-        wiki_paths = list(set(wiki_paths))
+    def prefetch_redirects(self, wiki_paths):
+        """
+        Request the redirects for all given Wikipedia paths in bulk,
+        e.g. for all link targets of the pages added to the Wikipedia dump.
+        """
+        wiki_paths = self._drop_known_wiki_paths(wiki_paths)
+        self.redirect_resolver.prefetch(wiki_paths)
 
-        # drop wiki_paths for which Wikidata mapping is already known (redirect not required)
-        wiki_paths = [
+    def _drop_known_wiki_paths(self, wiki_paths):
+        """
+        Drop wiki_paths for which Wikidata mapping is already known (redirect not required).
+        """
+        return [
             wiki_path
-            for wiki_path in wiki_paths
+            for wiki_path in set(wiki_paths)
             if wiki_path and self._wiki_path_to_wikidata(wiki_path, {}) is None
         ]
 
-        # limit for wiki_paths per request is 50
-        start_index = 0
-        redirects = dict()
-        while start_index < len(wiki_paths):
-            end_index = min(start_index + MAX_WIKI_PATHS_PER_REQ, len(wiki_paths) - 1)
-            wiki_paths_batch = wiki_paths[start_index:end_index]
-            new_redirects = self._extract_redirects_for_50(wiki_paths_batch)
-            redirects.update(new_redirects)
-            start_index += MAX_WIKI_PATHS_PER_REQ
-        return redirects
-
-    def _extract_redirects_for_50(self, wiki_paths):
-        """
-        Extract redirects of given (max.) 50 Wikipedia paths (one entity can have multiple paths).
-        Used in extract_redirects function for efficiency.
-        """
-        if not wiki_paths:
-            return {}
-
-        # initialize
-        redirects = dict()
-
-        try:
-            # create request url
-            wiki_paths_string = "|".join(wiki_paths)
-            url = f"https://en.wikipedia.org/w/api.php?action=query&format=json&titles={wiki_paths_string}&redirects"
-
-            # retrieve result
-            res = requests.get(url)
-            res_dict = json.loads(res.content)
-
-            ## result has mappings:
-            #   normalized: wiki_path -> wiki_title
-            #   redirects: wiki_title -> redirected wiki_title
-            if res_dict["query"].get("normalized"):
-                normalized = {
-                    normalized["to"]: normalized["from"]
-                    for normalized in res_dict["query"]["normalized"]
-                }
-            else:
-                normalized = dict()
-
-            # if redirects not set, no redirects required!
-            if not res_dict["query"].get("redirects"):
-                return redirects
-
-            # create redirects dict
-            for redirect in res_dict["query"]["redirects"]:
-                # get key
-                if normalized.get(redirect["from"]):
-                    key = normalized[redirect["from"]]
-                else:
-                    key = redirect["from"]
-
-                # add entry
-                redirects[key] = redirect["to"]
-
-        # catch exception and log problem
-        except Exception as e:
-            print(f"Error catched for url: {url}")
-            print(e)
-            traceback.print_tb(e.__traceback__)
-
-        return redirects
-
     def store_cache(self):
-        """Store the cache to disk."""
+        """Store the cache and the redirects to disk."""
+        self.redirect_resolver.store()
+        if not self.cache_changed:
+            return
+        cache_dir = os.path.dirname(self.path)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
         with open(self.path, "wb") as fp:
             pickle.dump(self.cache, fp)
+        self.cache_changed = False
 
     def _init_cache(self):
         """Initialize the cache."""
@@ -313,3 +277,4 @@ class EvidenceAnnotator:
                 self.cache = pickle.load(fp)
         else:
             self.cache = dict()
+        self.cache_changed = False
@@ -0,0 +1,169 @@
+import os
+import json
+import pickle
+import requests
+
+from pathlib import Path
+from urllib.parse import unquote
+from filelock import FileLock
+from concurrent.futures import ThreadPoolExecutor
+
+from convinse.library.utils import get_logger
+
+API_URL = "https://en.wikipedia.org/w/api.php"
+MAX_WIKI_PATHS_PER_REQ = 50
+
+
+class RedirectResolver:
+    """
+    Resolve redirects of Wikipedia paths, backed by a persistent store.
+    Paths without redirect are stored as well (negative caching), such that
+    each path is requested from the Wikipedia API at most once.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = get_logger(__name__, config)
+        self.store_path = config["ers_redirects_path"]
+        self.max_workers = config["ers_redirects_max_workers"]
+
+        # create session for faster connections
+        self.request_session = requests.Session()
+
+        # initialize store: wiki_path -> redirected wiki_title (None if no redirect)
+        self._init_store()
+        self.store_changed = False
+
+    def resolve(self, wiki_paths):
+        """
+        Return the redirects for the given Wikipedia paths.
+        Only paths which are not in the store are requested from the API.
+        Format: wiki_path -> redirected wiki_title.
+        """
+        self.prefetch(wiki_paths)
+        return {
+            wiki_path: self.redirects[wiki_path]
+            for wiki_path in set(wiki_paths)
+            if self.redirects.get(wiki_path)
+        }
+
+    def prefetch(self, wiki_paths):
+        """
+        Request the redirects for all given Wikipedia paths which are not in the store yet.
+        Requests are sent in batches of 50 paths (limit of the API),
+        and several batches are sent concurrently.
+        """
+        missing_paths = sorted(
+            set(
+                wiki_path
+                for wiki_path in wiki_paths
+                if wiki_path and not wiki_path in self.redirects
+            )
+        )
+        if not missing_paths:
+            return
+
+        # limit for wiki_paths per request is 50
+        batches = [
+            missing_paths[start_index : start_index + MAX_WIKI_PATHS_PER_REQ]
+            for start_index in range(0, len(missing_paths), MAX_WIKI_PATHS_PER_REQ)
+        ]
+        self.logger.debug(f"Requesting redirects for {len(missing_paths)} Wikipedia paths.")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, batch_redirects in zip(
+                batches, executor.map(self._request_redirects, batches)
+            ):
+                # failed requests are not remembered (retried next time)
+                if batch_redirects is None:
+                    continue
+                for wiki_path in batch:
+                    self.redirects[wiki_path] = batch_redirects.get(wiki_path)
+                self.store_changed = True
+
+    def _request_redirects(self, wiki_paths):
+        """
+        Request redirects of given (max.) 50 Wikipedia paths (one entity can have multiple paths).
+        Returns None in case the request failed.
+        """
+        # initialize
+        redirects = dict()
+
+        # create request (titles are encoded by requests, e.g. "&", "+", "#" or "%")
+        # paths from anchors are percent-encoded: decode them, and map the titles back to the paths
+        title_to_path = {unquote(wiki_path): wiki_path for wiki_path in wiki_paths}
+        params = {
+            "action": "query",
+            "format": "json",
+            "titles": "|".join(title_to_path.keys()),
+            "redirects": "",
+        }
+
+        try:
+            # retrieve result
+            res = self.request_session.get(API_URL, params=params)
+            res_dict = json.loads(res.content)
+
+            ## result has mappings:
+            #   normalized: wiki_path -> wiki_title
+            #   redirects: wiki_title -> redirected wiki_title
+            if res_dict["query"].get("normalized"):
+                normalized = {
+                    normalized["to"]: normalized["from"]
+                    for normalized in res_dict["query"]["normalized"]
+                }
+            else:
+                normalized = dict()
+
+            # if redirects not set, no redirects required!
+            if not res_dict["query"].get("redirects"):
+                return redirects
+
+            # create redirects dict
+            for redirect in res_dict["query"]["redirects"]:
+                # get key
+                if normalized.get(redirect["from"]):
+                    key = normalized[redirect["from"]]
+                else:
+                    key = redirect["from"]
+
+                # add entry
+                redirects[title_to_path.get(key, key)] = redirect["to"]
+
+        # catch exception and log problem
+        except Exception as e:
+            self.logger.warning(f"Error catched for titles: {params['titles']}: {e}")
+            return None
+
+        return redirects
+
+    def store(self):
+        """Store the redirects to disk (merged with updates of other processes)."""
+        if not self.store_changed:
+            return
+        self.logger.info(f"Writing Wikipedia redirects at path {self.store_path}.")
+        with FileLock(f"{self.store_path}.lock"):
+            redirects = self._read_store()
+            redirects.update(self.redirects)
+            self._write_store(redirects)
+        self.store_changed = False
+
+    def _init_store(self):
+        """Initialize the store."""
+        store_dir = os.path.dirname(self.store_path)
+        Path(store_dir).mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.store_path}.lock"):
+            self.redirects = self._read_store()
+
+    def _read_store(self):
+        """Read the current version of the store."""
+        if not os.path.isfile(self.store_path):
+            return dict()
+        with open(self.store_path, "rb") as fp:
+            return pickle.load(fp)
+
+    def _write_store(self, redirects):
+        """Write to the store."""
+        store_dir = os.path.dirname(self.store_path)
+        Path(store_dir).mkdir(parents=True, exist_ok=True)
+        with open(self.store_path, "wb") as fp:
+            pickle.dump(redirects, fp)
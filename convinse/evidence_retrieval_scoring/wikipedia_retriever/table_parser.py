@@ -1,20 +1,31 @@
+import re
+
 import mwparserfromhell as mwp
 from wikitables import WikiTable
 from wikitables.util import ftag
 
+# table delimiters in wikitext: "{|" and "|}" at the start of a line (but not "|}}",
+# which closes a template), or html tags
+TABLE_DELIMITER_PATTERN = re.compile(
+    r"(?P<open>^[ \t:]*\{\||<table\b)|(?P<close>^[ \t]*\|\}(?!\})|</table\s*>)",
+    re.IGNORECASE | re.MULTILINE,
+)
+
 
-def json_tables_to_evidences(tables, wiki_title):
+def json_tables_to_evidences(tables, wiki_title, max_rows=None):
     """
     Convert the table parsed by wikitables-module to evidences.
+    At most max_rows evidences are created (if set).
     """
     evidences = list()
     # for each table in document
     for table in tables:
         # row-wise table processing
         for row in table.rows:
-            evidence_text = f"{wiki_title}"
-            for key, value in row.items():
-                evidence_text += f", {key} is {value}"
+            if max_rows and len(evidences) >= max_rows:
+                return evidences
+            cells = [f"{key} is {value}" for key, value in row.items()]
+            evidence_text = ", ".join([wiki_title] + cells)
 
             # create evidence
             evidence = {"evidence_text": evidence_text, "source": "table"}
@@ -45,12 +56,40 @@ def _import_tables(content, title, lang="en"):
     """
     Extract tables from the given markdown content
     using the wikitables module and mwparser.
+    Only the table spans are parsed (not the full document).
     """
-    raw_tables = mwp.parse(content).filter_tags(matches=ftag("table"))
+    table_spans = _locate_table_spans(content)
 
     def _table_gen():
-        for idx, table in enumerate(raw_tables):
-            name = "%s[%s]" % (title, idx)
-            yield WikiTable(name, table)
+        idx = 0
+        for start, end in table_spans:
+            raw_tables = mwp.parse(content[start:end]).filter_tags(matches=ftag("table"))
+            for table in raw_tables:
+                name = "%s[%s]" % (title, idx)
+                idx += 1
+                yield WikiTable(name, table)
 
     return list(_table_gen())
+
+
+def _locate_table_spans(content):
+    """
+    Locate the (outermost) tables in the given markdown content
+    within a single linear scan. Returns a list of (start, end) tuples.
+    """
+    spans = list()
+    depth = 0
+    start = None
+    for match in TABLE_DELIMITER_PATTERN.finditer(content):
+        if match.group("open"):
+            if depth == 0:
+                start = match.start("open")
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+            if depth == 0:
+                spans.append((start, match.end("close")))
+    # table not closed: parse until the end of the document
+    if depth > 0:
+        spans.append((start, len(content)))
+    return spans
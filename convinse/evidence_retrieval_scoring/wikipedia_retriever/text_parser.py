@@ -1,39 +1,70 @@
 import re
 
+HEADING_PATTERN = re.compile(r"==.*?==+")
+WHITESPACE_PATTERN = re.compile(r" {2,}")
 
-def extract_text_snippets(wiki_md, wiki_title, nlp):
+# lightweight sentence boundaries: punctuation followed by whitespace and a new sentence start,
+# except for initials (e.g. "J. R. R. Tolkien")
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.!?])(?<!\b[A-Z]\.)\s+(?=[\"'(\[]?[A-Z0-9])")
+
+
+def extract_text_snippets_batch(pages, nlp, sentence_splitter="spacy", n_process=1, batch_size=16):
     """
-    Extract text snippets from the given
-    markdown text.
+    Extract text snippets for several pages at once.
+    The given pages are (wiki_md, wiki_title) tuples. With the spaCy
+    splitter, the sentences of all pages are segmented in a single
+    nlp.pipe call (optionally across several processes).
+    Yields (page_index, evidence) tuples.
     """
-    if not wiki_md or not wiki_md.get("extract"):
-        return []
+    # remove noise (pages without text are skipped)
+    page_indices = list()
+    clean_contents = list()
+    for i, (wiki_md, _) in enumerate(pages):
+        if not wiki_md or not wiki_md.get("extract"):
+            continue
+        page_indices.append(i)
+        clean_contents.append(_filter_noise(wiki_md["extract"]))
 
-    # load content
-    content = wiki_md["extract"]
+    # split the given documents into sentences
+    if sentence_splitter == "rule":
+        docs_sentences = (_split_sentences(content) for content in clean_contents)
+    else:
+        docs = nlp.pipe(clean_contents, n_process=n_process, batch_size=batch_size)
+        docs_sentences = ((sent.text for sent in doc.sents) for doc in docs)
 
-    # remove noise and load doc
-    clean_content = _filter_noise(content)
-    doc = nlp(clean_content)
+    for i, sentences in zip(page_indices, docs_sentences):
+        _, wiki_title = pages[i]
+        for evidence in _sentences_to_evidences(sentences, wiki_title):
+            yield i, evidence
 
-    # split the given document into sentences
-    evidences = list()
-    for sent in doc.sents:
+
+def _sentences_to_evidences(sentences, wiki_title):
+    """
+    Create evidences from the given sentences.
+    """
+    for sentence in sentences:
         # drop empty sentences
-        if not sent.text.strip():
+        sentence = sentence.strip()
+        if not sentence:
             continue
 
         # prepend wiki_title for context
-        evidence_text = f"{wiki_title}, {sent.text.strip()}"
+        evidence_text = f"{wiki_title}, {sentence}"
 
         # create evidence object
-        evidence = {
+        yield {
             # entities are added later by EvidenceAnnotator
             "evidence_text": evidence_text,
             "source": "text",
         }
-        evidences.append(evidence)
-    return evidences
+
+
+def _split_sentences(content):
+    """
+    Split the given text into sentences using simple rules.
+    Faster alternative to the spaCy sentencizer.
+    """
+    return SENTENCE_BOUNDARY_PATTERN.split(content)
 
 
 def _filter_noise(wiki_content):
@@ -46,8 +77,7 @@ def _filter_noise(wiki_content):
     content = wiki_content.split("== References ==")[0]
     content = wiki_content.split("== Further reading ==")[0]
     # clean text
-    content = re.sub(r"==.*?==+", "", content)
+    content = HEADING_PATTERN.sub("", content)
     content = content.replace("\n", " ")
-    while "  " in content:
-        content = content.replace("  ", " ")
+    content = WHITESPACE_PATTERN.sub(" ", content)
     return content
@@ -5,14 +5,15 @@ import spacy
 import sys
 import time
 import pickle
-import json
+from tqdm import tqdm
 from bs4 import BeautifulSoup
 
 from convinse.library.utils import get_config, get_logger
+from convinse.library.compact_mapping import load_compact_mapping
 import convinse.library.wikipedia_library as wiki
 
 from convinse.evidence_retrieval_scoring.wikipedia_retriever.text_parser import (
-    extract_text_snippets,
+    extract_text_snippets_batch,
 )
 from convinse.evidence_retrieval_scoring.wikipedia_retriever.table_parser import (
     extract_wikipedia_tables,
@@ -52,18 +53,19 @@ class WikipediaRetriever:
         self._init_wikipedia_dump()
 
         if self.on_the_fly:
-            # open dicts
-            with open(config["path_to_wikidata_mappings"], "r") as fp:
-                self.wikidata_mappings = json.load(fp)
-            with open(config["path_to_wikipedia_mappings"], "r") as fp:
-                self.wikipedia_mappings = json.load(fp)
+            # open mappings (memory-mapped, built once from the .json files)
+            self.wikidata_mappings = load_compact_mapping(config["path_to_wikidata_mappings"])
+            self.wikipedia_mappings = load_compact_mapping(config["path_to_wikipedia_mappings"])
 
             # initialize evidence annotator (used for (text)->Wikipedia->Wikidata)
             self.annotator = EvidenceAnnotator(config, self.wikidata_mappings)
 
-            # load nlp pipeline
-            self.nlp = spacy.blank("en")
-            self.nlp.add_pipe("sentencizer")
+            # load nlp pipeline (not required for rule-based sentence splitting)
+            self.sentence_splitter = config["evr_sentence_splitter"]
+            self.nlp = None
+            if self.sentence_splitter == "spacy":
+                self.nlp = spacy.blank("en")
+                self.nlp.add_pipe("sentencizer")
         self.logger.debug("WikipediaRetriever successfully initialized!")
 
     def retrieve_wp_evidences(self, question_entity_id):
@@ -72,28 +74,88 @@ class WikipediaRetriever:
         Always returns the full set of evidences (text, table, infobox).
         Filtering is done via filter_evidences function.
         """
-        if question_entity_id in self.wikipedia_dump:
-            self.logger.debug(f"Found Wikipedia evidences in dump!")
-            return self.wikipedia_dump.get(question_entity_id)
+        return self.retrieve_wp_evidences_batch([question_entity_id])[question_entity_id]
 
-        if not self.on_the_fly:
-            self.logger.debug(f"No Wikipedia evidences in dump, but on-the-fly retrieval not active!")
-            return []
+    def retrieve_wp_evidences_batch(self, question_entity_ids, n_process=1):
+        """
+        Retrieve evidences from Wikipedia for several Wikidata IDs at once.
+        All pages not present in the dump are retrieved first, and the text
+        of these pages is then segmented into sentences in a single batch.
+        Returns a dict from Wikidata ID to evidences.
+        """
+        results = dict()
+        pages = list()
+        for question_entity_id in question_entity_ids:
+            if question_entity_id in results:
+                continue
+
+            if question_entity_id in self.wikipedia_dump:
+                self.logger.debug(f"Found Wikipedia evidences in dump!")
+                results[question_entity_id] = self.wikipedia_dump.get(question_entity_id)
+                continue
+
+            if not self.on_the_fly:
+                self.logger.debug(f"No Wikipedia evidences in dump, but on-the-fly retrieval not active!")
+                results[question_entity_id] = []
+                continue
+
+            page = self._retrieve_page(question_entity_id)
+            if page is None:
+                self.wikipedia_dump[question_entity_id] = [] # remember
+                results[question_entity_id] = []
+                continue
+            pages.append(page)
+            # mark as processed (evidences are added below)
+            results[question_entity_id] = None
+
+        if not pages:
+            return results
+
+        # request redirects for all link targets of the new pages in bulk
+        self.annotator.prefetch_redirects(
+            [wiki_path for page in pages for wiki_path in page["doc_anchor_dict"].values()]
+        )
+
+        # retrieve text snippets for all pages in one batch
+        text_snippets = self._retrieve_text_snippets_batch(pages, n_process)
+
+        for page, page_text_snippets in zip(pages, text_snippets):
+            question_entity_id = page["question_entity_id"]
+
+            # prune e.g. too long evidences
+            evidences = page["infobox_evidences"] + page["table_records"] + page_text_snippets
+            evidences = self.filter_and_clean_evidences(evidences)
+
+            ## add wikidata entities (for table and text)
+            # evidences with no wikidata entities (except for the wiki_path) are dropped
+            self.annotator.annotate_wikidata_entities(
+                page["wiki_path"], evidences, page["doc_anchor_dict"]
+            )
+
+            # store result in dump
+            self.wikipedia_dump[question_entity_id] = evidences
+            results[question_entity_id] = evidences
+            self.logger.debug(f"Evidences successfully retrieved for {question_entity_id}.")
+        return results
 
+    def _retrieve_page(self, question_entity_id):
+        """
+        Retrieve the Wikipedia page for the given Wikidata ID, and extract
+        the anchors, infobox entries and table records. Text snippets are
+        extracted later (in batch). Returns None if no page was found.
+        """
         # get Wikipedia title
         wiki_path = self.wikipedia_mappings.get(question_entity_id)
         if not wiki_path:
             self.logger.debug(f"No Wikipedia link found for this Wikidata ID: {question_entity_id}.")
-            self.wikipedia_dump[question_entity_id] = [] # remember
-            return []
+            return None
         self.logger.debug(f"Retrieving Wikipedia evidences for: {wiki_path}.")
 
         # retrieve Wikipedia soup
         wiki_title = wiki._wiki_path_to_title(wiki_path)
         soup = self._retrieve_soup(wiki_title)
         if soup is None:
-            self.wikipedia_dump[question_entity_id] = [] # remember
-            return []
+            return None
 
         # retrieve Wikipedia markdown
         wiki_md = self._retrieve_markdown(wiki_title)
@@ -104,21 +166,15 @@ class WikipediaRetriever:
         # retrieve evidences
         infobox_evidences = self._retrieve_infobox_entries(wiki_title, soup, doc_anchor_dict)
         table_records = self._retrieve_table_records(wiki_title, wiki_md)
-        text_snippets = self._retrieve_text_snippets(wiki_title, wiki_md)
-
-        # prune e.g. too long evidences
-        evidences = infobox_evidences + table_records + text_snippets
-        evidences = self.filter_and_clean_evidences(evidences)
-
-        ## add wikidata entities (for table and text)
-        # evidences with no wikidata entities (except for the wiki_path) are dropped
-        self.annotator.annotate_wikidata_entities(wiki_path, evidences, doc_anchor_dict)
-
-        # store result in dump
-        self.wikipedia_dump[question_entity_id] = evidences
-
-        self.logger.debug(f"Evidences successfully retrieved for {question_entity_id}.")
-        return evidences
+        return {
+            "question_entity_id": question_entity_id,
+            "wiki_path": wiki_path,
+            "wiki_title": wiki_title,
+            "wiki_md": wiki_md,
+            "doc_anchor_dict": doc_anchor_dict,
+            "infobox_evidences": infobox_evidences,
+            "table_records": table_records,
+        }
 
     def filter_and_clean_evidences(self, evidences):
         """
@@ -179,16 +235,44 @@ class WikipediaRetriever:
         # extract wikipedia tables
         tables = extract_wikipedia_tables(wiki_md)
 
-        # extract evidences from tables
-        evidences = json_tables_to_evidences(tables, wiki_title)
+        # extract evidences from tables (number of rows per page is limited)
+        max_rows = self.config["evr_max_table_rows_per_page"]
+        evidences = json_tables_to_evidences(tables, wiki_title, max_rows=max_rows)
         return evidences
 
-    def _retrieve_text_snippets(self, wiki_title, wiki_md):
+    def build_dump(self, question_entity_ids, chunk_size=1000):
         """
-        Retrieve text snippets for the given Wikidata entity.
+        Extend the Wikipedia dump with the evidences of the given Wikidata IDs (in bulk).
+        Pages are processed in chunks, and sentences are segmented with
+        `evr_nlp_n_process` processes (one process pool per chunk).
         """
-        evidences = extract_text_snippets(wiki_md, wiki_title, self.nlp)
-        return evidences
+        missing_ids = [
+            question_entity_id
+            for question_entity_id in dict.fromkeys(question_entity_ids)
+            if not question_entity_id in self.wikipedia_dump
+        ]
+        self.logger.info(f"Building Wikipedia dump for {len(missing_ids)} entities.")
+        n_process = self.config["evr_nlp_n_process"]
+        for start in tqdm(range(0, len(missing_ids), chunk_size)):
+            self.retrieve_wp_evidences_batch(missing_ids[start : start + chunk_size], n_process)
+        self.store_dump()
+
+    def _retrieve_text_snippets_batch(self, pages, n_process=1):
+        """
+        Retrieve text snippets for the given pages (in batch).
+        Returns a list of evidences for each page.
+        """
+        text_snippets = [list() for _ in pages]
+        page_inputs = [(page["wiki_md"], page["wiki_title"]) for page in pages]
+        for i, evidence in extract_text_snippets_batch(
+            page_inputs,
+            self.nlp,
+            sentence_splitter=self.sentence_splitter,
+            n_process=n_process,
+            batch_size=self.config["evr_nlp_batch_size"],
+        ):
+            text_snippets[i].append(evidence)
+        return text_snippets
 
     def _build_document_anchor_dict(self, soup):
         """
@@ -263,6 +347,9 @@ class WikipediaRetriever:
 
     def store_dump(self):
         """Store the updated Wikipedia dump."""
+        if self.on_the_fly:
+            # store Wikipedia redirects and Wikipedia->Wikidata mappings
+            self.annotator.store_cache()
         if len(self.wikipedia_dump) > self.wikipedia_dump_version:
             self.logger.info("Wikipedia dump extended! Storing data on disk.")
             path_to_dump = self.config["ers_wikipedia_dump"]
@@ -272,26 +359,40 @@ class WikipediaRetriever:
 #######################################################################################################################
 #######################################################################################################################
 if __name__ == "__main__":
-    # RUN: python convinse.evidence_retrieval_scoring/wikipedia_retriever/wikipedia_retriever.py config/convmix/convinse.yml
-    if len(sys.argv) != 2:
+    # RUN: python convinse.evidence_retrieval_scoring/wikipedia_retriever/wikipedia_retriever.py [--build-dump] config/convmix/convinse.yml
+    if not len(sys.argv) in [2, 3]:
         raise Exception(
-            "python convinse.evidence_retrieval_scoring/wikipedia_retriever/wikipedia_retriever.py <PATH_TO_CONFIG>"
+            "python convinse.evidence_retrieval_scoring/wikipedia_retriever/wikipedia_retriever.py [--build-dump] <PATH_TO_CONFIG>"
         )
 
     # load config
-    config_path = sys.argv[1]
+    config_path = sys.argv[-1]
     config = get_config(config_path)
 
     # create retriever
     retriever = WikipediaRetriever(config)
 
-    # retrieve evidences
-    start = time.time()
-    question_entity = {"id": "Q23572", "label": "Game of Thrones"}
-    evidences = retriever.retrieve_wp_evidences(question_entity["id"])
-    print("Time consumed", time.time() - start)
-
-    # show evidences
-    for evidence in evidences:
-        print(evidence)
-        break
+    # build dump for all question entities in the ER cache (in bulk)
+    if len(sys.argv) == 3:
+        if sys.argv[1] != "--build-dump":
+            raise Exception(f"Unknown function {sys.argv[1]}!")
+        with open(config["ers_cache_path"], "rb") as fp:
+            er_cache = pickle.load(fp)
+        question_entity_ids = [
+            question_entity["item"]["id"]
+            for _, question_entities in er_cache["kb"].values()
+            for question_entity in question_entities
+        ]
+        retriever.build_dump(question_entity_ids)
+
+    # retrieve evidences for an example entity
+    else:
+        start = time.time()
+        question_entity = {"id": "Q23572", "label": "Game of Thrones"}
+        evidences = retriever.retrieve_wp_evidences(question_entity["id"])
+        print("Time consumed", time.time() - start)
+
+        # show evidences
+        for evidence in evidences:
+            print(evidence)
+            break
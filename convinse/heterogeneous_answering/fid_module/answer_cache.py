@@ -0,0 +1,92 @@
+import os
+import json
+import pickle
+import hashlib
+
+from pathlib import Path
+from filelock import FileLock
+
+from convinse.library.utils import get_logger
+
+# config parameters that affect the generated answers
+ANSWER_CONFIG_KEYS = [
+    "fid_model_path",
+    "fid_max_evidences",
+    "fid_text_maxlength",
+    "fid_num_beams",
+    "fid_quantize",
+]
+
+
+class AnswerCache:
+    """
+    Persistent cache of answers generated by FiD, keyed by hash of
+    (model checkpoint, generation config, question token IDs, passage token IDs).
+    The checkpoint is identified by its path and the modification time of its weights,
+    such that answers of a re-trained model are not re-used.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = get_logger(__name__, config)
+        self.cache_path = config["fid_answer_cache_path"]
+        self.model_hash = self._model_hash(config)
+
+        # initialize cache: hash -> generated answer
+        self._init_cache()
+        self.new_answers = dict()
+
+    def get(self, instance):
+        """Look-up the answer for the given pre-tokenized instance (None if not cached)."""
+        key = self.key(instance)
+        if key in self.new_answers:
+            return self.new_answers[key]
+        return self.answers.get(key)
+
+    def set(self, instance, answer):
+        """Remember the answer generated for the given pre-tokenized instance."""
+        self.new_answers[self.key(instance)] = answer
+
+    def key(self, instance):
+        content = json.dumps([self.model_hash, instance["question_ids"], instance["passage_ids"]])
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def store(self):
+        """Store the cache to disk (merged with updates of other processes)."""
+        if not self.new_answers:
+            return
+        self.logger.info(f"Writing answer cache at path {self.cache_path}.")
+        with FileLock(f"{self.cache_path}.lock"):
+            answers = self._read_cache()
+            answers.update(self.new_answers)
+            self._write_cache(answers)
+        self.answers = answers
+        self.new_answers = dict()
+
+    def _model_hash(self, config):
+        """Hash of the model checkpoint and the config parameters the answers depend on."""
+        weights_path = os.path.join(config["fid_model_path"], "pytorch_model.bin")
+        mtime = os.path.getmtime(weights_path) if os.path.isfile(weights_path) else None
+        values = json.dumps([config[key] for key in ANSWER_CONFIG_KEYS] + [mtime])
+        return hashlib.md5(values.encode("utf-8")).hexdigest()
+
+    def _init_cache(self):
+        """Initialize the cache."""
+        Path(os.path.dirname(self.cache_path)).mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.cache_path}.lock"):
+            self.answers = self._read_cache()
+        self.logger.info(f"Answer cache loaded with {len(self.answers)} answers.")
+
+    def _read_cache(self):
+        """Read the current version of the cache."""
+        if not os.path.isfile(self.cache_path):
+            return dict()
+        with open(self.cache_path, "rb") as fp:
+            return pickle.load(fp)
+
+    def _write_cache(self, answers):
+        """Write to the cache."""
+        cache_dir = os.path.dirname(self.cache_path)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, "wb") as fp:
+            pickle.dump(answers, fp)
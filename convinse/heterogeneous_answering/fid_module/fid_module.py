@@ -2,13 +2,20 @@ import os
 import sys
 import json
 import time
+import uuid
 import torch
-import random
 
-from subprocess import Popen, PIPE
+from pathlib import Path
+from subprocess import Popen
 
-from convinse.library.utils import get_config, store_json_with_mkdir
+from convinse.library.utils import get_config, get_logger, store_json_with_mkdir
 import convinse.heterogeneous_answering.fid_module.fid_utils as fid_utils
+from convinse.heterogeneous_answering.fid_module.fid_reader import (
+    create_fid_reader,
+    get_fid_reader,
+)
+from convinse.heterogeneous_answering.fid_module.answer_cache import AnswerCache
+from convinse.heterogeneous_answering.fid_module.token_cache import get_token_cache
 from convinse.heterogeneous_answering.heterogeneous_answering import HeterogeneousAnswering
 import convinse.evaluation as evaluation
 
@@ -17,9 +24,20 @@ class FiDModule(HeterogeneousAnswering):
     def __init__(self, config):
         """Initialize the FiD module."""
         self.config = config
+        self.logger = get_logger(__name__, config)
         self.path_to_fid = "convinse/heterogeneous_answering/fid_module/FiD"
+        self.path_to_worker = "convinse/heterogeneous_answering/fid_module/fid_worker.py"
         self._initialize_conda_dir()
 
+        # resident FiD reader(s) (shared within process, started on first inference)
+        self.num_workers = config["fid_num_workers"]
+        self.reader = get_fid_reader(self._worker_command(), self.num_workers)
+
+        # initialize answer cache
+        self.use_answer_cache = config["fid_use_answer_cache"]
+        if self.use_answer_cache:
+            self.answer_cache = AnswerCache(config)
+
     def train(self, sources=["kb", "text", "table", "info"]):
         """ Train the FiD model on the dataset. """
         # set paths
@@ -48,8 +66,8 @@ class FiDModule(HeterogeneousAnswering):
             dev_input_turns = [turn for conv in dev_data for turn in conv["questions"]]
 
         # prepare paths
-        prepared_train_path, _ = self._prepare_paths()
-        prepared_dev_path, _ = self._prepare_paths()
+        prepared_train_path = self._prepare_path()
+        prepared_dev_path = self._prepare_path()
 
         # prepare data
         fid_utils.prepare_data(self.config, train_input_turns, prepared_train_path, train=True)
@@ -66,18 +84,13 @@ class FiDModule(HeterogeneousAnswering):
 
     def inference_on_turns(self, input_turns):
         """Run HA on given turns."""
-        # paths
-        prepared_input_path, res_name = self._prepare_paths()
-
         # prepare data
-        fid_utils.prepare_data(self.config, input_turns, prepared_input_path)
+        instances = fid_utils.prepare_instances(self.config, input_turns, tokenize=True)
+        # batch turns with similar numbers of contexts together (if no token budget is set)
+        instances.sort(key=lambda instance: len(instance["passage_ids"]))
 
         # inference
-        self._inference(res_name, prepared_input_path)
-
-        # parse result
-        path_to_result = f"{self.path_to_fid}/tmp_output_data/{res_name}/final_output.txt"
-        generated_answers = self._parse_result(path_to_result)
+        generated_answers = self._generate(instances)
 
         # add predicted answers to turns
         for turn in input_turns:
@@ -86,23 +99,64 @@ class FiDModule(HeterogeneousAnswering):
 
     def inference_on_turn(self, turn):
         """Run HA on a single turn."""
-        # paths
-        prepared_input_path, res_name = self._prepare_paths()
-
         # prepare data
-        fid_utils.prepare_turn(self.config, turn, prepared_input_path, train=False)
+        instances = fid_utils.prepare_instances(self.config, [turn], train=False, tokenize=True)
+        if not instances:
+            sr = turn["structured_representation"]
+            raise Exception(f"No evidences found for this turn! SR: {sr}.")
 
         # inference
-        self._inference(res_name, prepared_input_path)
-
-        # parse result
-        path_to_result = f"{self.path_to_fid}/tmp_output_data/{res_name}/final_output.txt"
-        generated_answers = self._parse_result(path_to_result)
+        generated_answers = self._generate(instances)
 
         # add predicted answers to turns
         self._postprocess_turn(turn, generated_answers)
         return turn
 
+    def store_cache(self):
+        """Store the caches of evidence token IDs and generated answers."""
+        get_token_cache(self.config).store()
+        if self.use_answer_cache:
+            self.answer_cache.store()
+
+    def _generate(self, instances):
+        """
+        Generate answers for the given pre-tokenized instances.
+        Answers of instances seen before (with the same model) are taken from the cache,
+        and only the remaining instances are sent to the reader.
+        """
+        if not self.use_answer_cache:
+            generated_answers = self.reader.generate(instances)
+            self._log_reader_stats()
+            return generated_answers
+
+        generated_answers = dict()
+        missing_instances = list()
+        for instance in instances:
+            answer = self.answer_cache.get(instance)
+            if answer is None:
+                missing_instances.append(instance)
+            else:
+                generated_answers[str(instance["id"])] = answer
+        if missing_instances:
+            new_answers = self.reader.generate(missing_instances)
+            self._log_reader_stats()
+            for instance in missing_instances:
+                answer = new_answers.get(str(instance["id"]))
+                if not answer is None:
+                    self.answer_cache.set(instance, answer)
+            generated_answers.update(new_answers)
+        return generated_answers
+
+    def _log_reader_stats(self):
+        """Log the throughput of the reader processes (with several workers)."""
+        if self.num_workers <= 1:
+            return
+        for worker, stats in enumerate(self.reader.stats()):
+            self.logger.info(
+                f"FiD worker {worker}: {stats['instances']} instances in {stats['seconds']:.1f}s "
+                f"({stats['throughput']:.2f} instances/s)."
+            )
+
     def _train(self, prepared_train_path, prepared_dev_path, sources_string):
         benchmark = self.config["benchmark"]
         method_name = self.config["name"]
@@ -127,18 +181,116 @@ class FiDModule(HeterogeneousAnswering):
         process = Popen(COMMAND, stdout=sys.stdout, stderr=sys.stderr)
         process.communicate()
 
-    def _inference(self, res_name, prepared_input_path):
-        """Run inference on a given question (or SR), and a set of evidences."""
-        COMMAND = [self.path_to_fid_python_env, f"{self.path_to_fid}/test_reader.py"]
-        COMMAND += ["--name", res_name]
+    def _worker_command(self, quantize=None, num_threads=None, num_beams=None):
+        """
+        Command for starting the resident FiD reader in the FiD environment.
+        The inference profile (quantization, threads, beams) is taken from the config by default.
+        """
+        quantize = self.config["fid_quantize"] if quantize is None else quantize
+        num_threads = self.config["fid_num_threads"] if num_threads is None else num_threads
+        # with several workers, the cores are split among the workers by default
+        if num_threads == 0 and self.config["fid_num_workers"] > 1:
+            num_threads = max(1, (os.cpu_count() or 1) // self.config["fid_num_workers"])
+        num_beams = self.config["fid_num_beams"] if num_beams is None else num_beams
+        COMMAND = [self.path_to_fid_python_env, self.path_to_worker]
+        COMMAND += ["--fid_path", self.path_to_fid]
         COMMAND += ["--model_path", self.config["fid_model_path"]]
-        COMMAND += ["--checkpoint_dir", f"{self.path_to_fid}/tmp_output_data"]
-        COMMAND += ["--eval_data", prepared_input_path]
         COMMAND += ["--n_context", str(self.config["fid_max_evidences"])]
         COMMAND += ["--per_gpu_batch_size", str(self.config["fid_per_gpu_batch_size"])]
-        COMMAND += ["--write_results"]
-        process = Popen(COMMAND, stdout=sys.stdout, stderr=sys.stderr)
-        process.communicate()
+        COMMAND += ["--text_maxlength", str(self.config["fid_text_maxlength"])]
+        COMMAND += ["--batch_token_budget", str(self.config["fid_batch_token_budget"])]
+        COMMAND += ["--num_threads", str(num_threads)]
+        COMMAND += ["--num_beams", str(num_beams)]
+        if quantize:
+            COMMAND += ["--quantize"]
+        return COMMAND
+
+    def evaluate_inference_profile(self, input_path, output_path):
+        """
+        Compare the configured inference profile (quantization, threads, beams)
+        with the default profile (full precision, greedy decoding) on the given data split.
+        Reports P@1 and latency per question for both profiles.
+        """
+        profiles = {
+            "default": self._worker_command(quantize=False, num_threads=0, num_beams=1),
+            "configured": self._worker_command(),
+        }
+        results = dict()
+        for profile, command in profiles.items():
+            # load data (turns are modified in postprocessing)
+            with open(input_path, "r") as fp:
+                input_turns = [turn for line in fp for turn in json.loads(line)["questions"]]
+            instances = fid_utils.prepare_instances(self.config, input_turns, tokenize=True)
+
+            # start (private) reader before measuring (model loading not included)
+            reader = create_fid_reader(command, self.num_workers)
+            reader.generate(instances[:1])
+            start = time.time()
+            generated_answers = reader.generate(instances)
+            latency = (time.time() - start) / max(len(instances), 1)
+            reader.close()
+
+            for turn in input_turns:
+                self._postprocess_turn(turn, generated_answers)
+            p_at_1 = sum(turn["p_at_1"] for turn in input_turns) / max(len(input_turns), 1)
+            results[profile] = {"p_at_1": p_at_1, "latency": latency}
+
+        # write results
+        with open(output_path, "w") as fp:
+            for profile, res in results.items():
+                fp.write(f"{profile}: P@1 {res['p_at_1']}, latency per question {res['latency']}s\n")
+            p_at_1_delta = results["configured"]["p_at_1"] - results["default"]["p_at_1"]
+            speedup = results["default"]["latency"] / max(results["configured"]["latency"], 1e-9)
+            fp.write(f"Delta P@1: {p_at_1_delta}, speedup: {speedup}")
+
+    def evaluate_context_cutoffs(self, input_path, output_path, thresholds=[0.3, 0.5, 0.7, 0.9]):
+        """
+        Compare fixed and adaptive numbers of contexts on the given data split.
+        For the configured cutoff (ratio or mass), each of the thresholds is evaluated.
+        Reports P@1, the average and median number of contexts,
+        and the latency per question for each setting.
+        """
+        cutoff = self.config["fid_context_cutoff"]
+        if cutoff == "fixed":
+            cutoff = "ratio"
+        settings = [("fixed", None)] + [(cutoff, threshold) for threshold in thresholds]
+        results = list()
+        for cutoff, threshold in settings:
+            config = dict(self.config, fid_context_cutoff=cutoff, fid_context_threshold=threshold)
+
+            # load data (turns are modified in postprocessing)
+            with open(input_path, "r") as fp:
+                input_turns = [turn for line in fp for turn in json.loads(line)["questions"]]
+            instances = fid_utils.prepare_instances(config, input_turns, tokenize=True)
+            instances.sort(key=lambda instance: len(instance["passage_ids"]))
+            num_contexts = [len(instance["passage_ids"]) for instance in instances] or [0]
+
+            # inference
+            self.reader.generate(instances[:1])
+            start = time.time()
+            generated_answers = self.reader.generate(instances)
+            latency = (time.time() - start) / max(len(instances), 1)
+
+            for turn in input_turns:
+                self._postprocess_turn(turn, generated_answers)
+            p_at_1 = sum(turn["p_at_1"] for turn in input_turns) / max(len(input_turns), 1)
+            results.append(
+                {
+                    "setting": f"{cutoff}" if threshold is None else f"{cutoff} ({threshold})",
+                    "p_at_1": p_at_1,
+                    "avg_contexts": sum(num_contexts) / len(num_contexts),
+                    "median_contexts": sorted(num_contexts)[len(num_contexts) // 2],
+                    "latency": latency,
+                }
+            )
+
+        # write results
+        with open(output_path, "w") as fp:
+            for res in results:
+                fp.write(
+                    f"{res['setting']}: P@1 {res['p_at_1']}, avg. contexts {res['avg_contexts']}, "
+                    f"median contexts {res['median_contexts']}, latency per question {res['latency']}s\n"
+                )
 
     def _postprocess_turn(self, turn, generated_answers):
         ques_id = turn["question_id"]
@@ -185,33 +337,10 @@ class FiDModule(HeterogeneousAnswering):
         if turn.get("silver_answering_evidences"):
             del turn["silver_answering_evidences"]
 
-    def _parse_result(self, path_to_result):
-        """
-        Parse the output generated by FiD, and add predicted
-        (and generated) answers to the data.
-        """
-        # get answers from output file
-        generated_answers = dict()
-        with open(path_to_result, "r") as fp:
-            line = fp.readline()
-            while line:
-                try:
-                    ques_id, answer = line.split(None, 1)
-                except:
-                    ques_id = line.strip()
-                    answer = ""
-                ques_id = ques_id.strip()
-                answer = answer.strip()
-                generated_answers[ques_id] = answer
-                line = fp.readline()
-        return generated_answers
-
-    def _prepare_paths(self):
-        """ Prepare random path for handling input/output with piped FiD process. """
-        random_num = str(random.randint(0, 10000))
-        prepared_input_path = f"{self.path_to_fid}/tmp_input_data/data_{random_num}.jsonl"
-        res_name = f"output_{random_num}"
-        return prepared_input_path, res_name
+    def _prepare_path(self):
+        """ Prepare unique path for passing (training) data to FiD process. """
+        prepared_input_path = f"{self.path_to_fid}/tmp_input_data/data_{uuid.uuid4().hex}.jsonl"
+        return prepared_input_path
 
     def _initialize_conda_dir(self):
         """ Code to automatically detect and set the path to the FiD environment."""
@@ -253,6 +382,36 @@ if __name__ == "__main__":
         fid = FiDModule(config)
         fid.train(train_path, dev_path)
 
+    elif function == "--evaluate-profile":
+        # set paths
+        qu = config["qu"]
+        ers = config["ers"]
+        input_dir = config["path_to_intermediate_results"]
+        data_sources_str = "kb_text_table_info"
+        path = os.path.join(input_dir, qu, ers, data_sources_str)
+        input_path = os.path.join(path, "dev_ers.jsonl")
+        output_path = os.path.join(path, "fid", "dev_profile.res")
+        Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
+
+        # compare inference profiles
+        fid = FiDModule(config)
+        fid.evaluate_inference_profile(input_path, output_path)
+
+    elif function == "--evaluate-contexts":
+        # set paths
+        qu = config["qu"]
+        ers = config["ers"]
+        input_dir = config["path_to_intermediate_results"]
+        data_sources_str = "kb_text_table_info"
+        path = os.path.join(input_dir, qu, ers, data_sources_str)
+        input_path = os.path.join(path, "dev_ers.jsonl")
+        output_path = os.path.join(path, "fid", "dev_contexts.res")
+        Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
+
+        # compare fixed and adaptive numbers of contexts
+        fid = FiDModule(config)
+        fid.evaluate_context_cutoffs(input_path, output_path)
+
     elif function == "--example":
         # set paths
         qu = config["qu"]
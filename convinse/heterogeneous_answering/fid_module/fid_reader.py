@@ -0,0 +1,213 @@
+import sys
+import json
+import time
+import atexit
+import threading
+
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+# max. number of instances sent to the FiD reader within a single request
+MAX_REQUEST_INSTANCES = 100
+
+# readers shared within the process (one per worker command)
+_READERS = dict()
+_READERS_LOCK = threading.Lock()
+
+
+def get_fid_reader(command, num_workers=1):
+    """
+    Get the FiD reader started with the given command.
+    With several workers, a pool of readers (one process each) is returned.
+    The reader is shared by all modules (and threads) in the process.
+    """
+    key = (tuple(command), num_workers)
+    with _READERS_LOCK:
+        if not key in _READERS:
+            _READERS[key] = create_fid_reader(command, num_workers)
+        return _READERS[key]
+
+
+def create_fid_reader(command, num_workers=1):
+    """
+    Create a private FiD reader (or pool of readers) for the given command,
+    which is not shared with other modules (the caller is responsible for closing it).
+    """
+    if num_workers > 1:
+        return FiDReaderPool(command, num_workers)
+    return FiDReader(command)
+
+
+class FiDReader:
+    """
+    Client for the resident FiD reader (fid_worker.py).
+    Requests and responses are streamed over pipes (JSON lines), and each
+    request carries an ID which is checked on the response.
+    Requests of concurrent threads are serialized.
+    If the reader terminates unexpectedly, it is restarted on the next request.
+    """
+
+    def __init__(self, command, max_request_instances=MAX_REQUEST_INSTANCES):
+        self.command = command
+        self.max_request_instances = max_request_instances
+        self.process = None
+        self.lock = threading.Lock()
+        self.next_request_id = 0
+        atexit.register(self.close)
+
+        # throughput stats
+        self.num_instances = 0
+        self.seconds = 0.0
+
+    def generate(self, instances):
+        """
+        Generate answers for the given prepared instances. Returns the answer per question ID.
+        Instances are sent in chunks of bounded size (one request each).
+        """
+        answers = dict()
+        for start in range(0, len(instances), self.max_request_instances):
+            chunk = instances[start : start + self.max_request_instances]
+            response = self.request({"instances": chunk})
+            answers.update(response["answers"])
+        return answers
+
+    def stats(self):
+        """Throughput stats of the reader (one entry per process)."""
+        throughput = self.num_instances / self.seconds if self.seconds else 0.0
+        return [
+            {"instances": self.num_instances, "seconds": self.seconds, "throughput": throughput}
+        ]
+
+    def request(self, request):
+        """Send a request to the FiD reader, and wait for the response."""
+        with self.lock:
+            if self.process is None:
+                self._start()
+            # time spent on the request (without starting the reader)
+            start = time.time()
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            try:
+                self.process.stdin.write(json.dumps(dict(request, id=request_id)))
+                self.process.stdin.write("\n")
+                self.process.stdin.flush()
+                response = self._read_response()
+            except Exception:
+                # reader died (or is out of sync): restart on next request
+                self._kill()
+                raise
+            self.num_instances += len(request.get("instances", []))
+            self.seconds += time.time() - start
+        if response.get("id") != request_id:
+            raise Exception(
+                f"FiD reader answered request {response.get('id')} instead of {request_id}!"
+            )
+        if "error" in response:
+            raise Exception(f"FiD reader failed: {response['error']}")
+        return response
+
+    def close(self):
+        """Stop the FiD reader (if running)."""
+        with self.lock:
+            if self.process is None:
+                return
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+    def _start(self):
+        """
+        Start the FiD reader in the FiD environment.
+        The model is loaded once, and kept in memory until the reader is closed.
+        """
+        self.process = Popen(
+            self.command,
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=sys.stderr,
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+        # wait until model is loaded
+        try:
+            response = self._read_response()
+        except Exception:
+            self._kill()
+            raise
+        if response.get("status") != "ready":
+            self._kill()
+            raise Exception(f"FiD reader could not be started: {response}")
+
+    def _kill(self):
+        """Kill the FiD reader process (if still running), and release its pipes."""
+        self.process.kill()
+        self.process.wait()
+        for pipe in [self.process.stdin, self.process.stdout]:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        self.process = None
+
+    def _read_response(self):
+        """Read the next response of the FiD reader."""
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception("FiD reader terminated unexpectedly!")
+        return json.loads(line)
+
+
+class FiDReaderPool:
+    """
+    Pool of resident FiD readers (one process with its own model copy each).
+    Instances are sharded across the readers, such that all readers get
+    a similar number of passages, and the answers of all shards are merged.
+    """
+
+    def __init__(self, command, num_workers):
+        self.readers = [FiDReader(command) for _ in range(num_workers)]
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def generate(self, instances):
+        """Generate answers for the given prepared instances. Returns the answer per question ID."""
+        shards = self._shard(instances)
+        futures = [
+            self.executor.submit(reader.generate, shard)
+            for reader, shard in zip(self.readers, shards)
+        ]
+        answers = dict()
+        for future in futures:
+            answers.update(future.result())
+        return answers
+
+    def stats(self):
+        """Throughput stats of the readers (one entry per process)."""
+        return [stats for reader in self.readers for stats in reader.stats()]
+
+    def close(self):
+        """Stop all FiD readers."""
+        for reader in self.readers:
+            reader.close()
+
+    def _shard(self, instances):
+        """
+        Assign instances to readers: largest instances first, each to the reader
+        with the least passages so far. The order within a shard is preserved.
+        """
+        loads = [0] * len(self.readers)
+        assignment = [list() for _ in self.readers]
+        sizes = [_num_passages(instance) for instance in instances]
+        for index in sorted(range(len(instances)), key=lambda i: -sizes[i]):
+            reader_index = loads.index(min(loads))
+            loads[reader_index] += sizes[index]
+            assignment[reader_index].append(index)
+        return [[instances[index] for index in sorted(indices)] for indices in assignment]
+
+
+def _num_passages(instance):
+    """Number of passages of the prepared instance (pre-tokenized or texts)."""
+    if "passage_ids" in instance:
+        return len(instance["passage_ids"])
+    return len(instance["ctxs"])
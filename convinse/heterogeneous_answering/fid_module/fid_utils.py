@@ -4,33 +4,13 @@ import json
 import random
 import logging
 
+import numpy as np
+
 from pathlib import Path
 
 from convinse.library.utils import get_config
 from convinse.evaluation import evidence_has_answer, question_is_existential
-
-
-def prepare_turn(config, input_turn, output_path, train=False):
-    """
-    Prepare the given turn for input into FiD.
-    Input will be top-100 evidences per question
-    as predicted by ERS stage.
-    Writes the result in the given output path.
-    """
-    # create output dir
-    output_dir = os.path.dirname(output_path)
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
-
-    # prepare
-    res = _prepare_turn(config, input_turn, train)
-    if res is None:
-        sr = input_turn["structured_representation"]
-        raise Exception(f"No evidences found for this turn! SR: {sr}.")
-    
-    # store
-    with open(output_path, "w") as fp:
-        fp.write(json.dumps(res))
-        fp.write("\n")
+from convinse.heterogeneous_answering.fid_module.token_cache import get_token_cache
 
 
 def prepare_data(config, input_turns, output_path, train=False):
@@ -61,7 +41,50 @@ def prepare_data(config, input_turns, output_path, train=False):
             fp_out.write("\n")
 
 
-def _prepare_turn(config, input_turn, train):
+def prepare_instances(config, input_turns, train=False, tokenize=False):
+    """
+    Prepare the given turns for input into FiD (without writing to disk).
+    Turns for which no evidences were found are skipped.
+    During inference, the number of contexts per turn is adapted to the
+    score distribution of the evidences (if enabled via `fid_context_cutoff`).
+    If tokenize is set, instances carry the token IDs instead of the texts.
+    """
+    instances = list()
+    for turn in input_turns:
+        # skip instances that are already processed
+        if not turn.get("pred_answers") is None:
+            continue
+
+        res = _prepare_turn(config, turn, train, adaptive=not train)
+        # skip turns for which no evidences were found
+        if res is None:
+            continue
+        if tokenize:
+            res = tokenize_instance(config, res)
+        instances.append(res)
+    return instances
+
+
+def tokenize_instance(config, instance):
+    """
+    Replace the question and passages of the prepared instance by their token IDs
+    (without special tokens), as FiD would encode them:
+    "question: <question> title: <title> context: <text>".
+    """
+    token_cache = get_token_cache(config)
+    question_ids = np.concatenate(token_cache.encode(["question:", instance["question"]]))
+    passage_ids = list()
+    for ctx in instance["ctxs"]:
+        ids = token_cache.encode(["title:", ctx["title"], "context:", ctx["text"]])
+        passage_ids.append(np.concatenate(ids).tolist())
+    return {
+        "id": instance["id"],
+        "question_ids": question_ids.tolist(),
+        "passage_ids": passage_ids,
+    }
+
+
+def _prepare_turn(config, input_turn, train, adaptive=False):
     """
     Prepare the given turn for input into FiD.
     Input will be top-100 evidences per question
@@ -71,11 +94,16 @@ def _prepare_turn(config, input_turn, train):
     # construct set of answers that are present (from silver evidences)
     answer_ids = [answer["id"] for answer in input_turn["answers"]]
 
+    # top evidences are a prefix of the ranking stored by ERS
+    max_evidences = min(config["evs_max_evidences"], config["fid_max_evidences"])
+    top_evidences = input_turn["top_evidences"][:max_evidences]
+    if adaptive:
+        top_evidences = top_evidences[: num_contexts(config, top_evidences)]
+
     # prepare target answers
     target_answers = set()
     # retrieve target answers from answering evidences -> preserve order!
-    evidences = input_turn["top_evidences"]
-    for evidence in evidences:
+    for evidence in top_evidences:
         if evidence_has_answer(evidence, input_turn["answers"]):
             for disambiguation in evidence["disambiguations"]:
                 if disambiguation[1] in answer_ids:
@@ -89,16 +117,10 @@ def _prepare_turn(config, input_turn, train):
     if not input_turn["answers"]:
         return None
 
-    evidences = input_turn["top_evidences"]
-    evidences = evidences[: config["fid_max_evidences"]]
-
     # create data
     answers = list(target_answers) + [answer["label"] for answer in input_turn["answers"]]
     target_answer = answers[0]  # always first element of target_answers
-    evidences = [
-        {"title": evidence["retrieved_for_entity"]["label"], "text": evidence["evidence_text"]}
-        for evidence in input_turn["top_evidences"]
-    ]
+    evidences = pack_evidences(config, input_turn["structured_representation"], top_evidences)
 
     # if there are no evidences, return None (=skip instance)
     if evidences == []:
@@ -111,4 +133,86 @@ def _prepare_turn(config, input_turn, train):
         "target": target_answer,
         "answers": answers,
         "ctxs": evidences,
-    }
\ No newline at end of file
+    }
+
+
+def num_contexts(config, evidences):
+    """
+    Number of contexts to use for the given ranked evidences, based on their scores.
+    Cutoffs (`fid_context_cutoff`):
+        - "fixed": all evidences (up to `fid_max_evidences`)
+        - "ratio": evidences with a score of at least `fid_context_threshold` times the top score
+        - "mass": smallest prefix with `fid_context_threshold` of the total score mass
+    The count is bounded by `fid_min_evidences` and `fid_max_evidences`.
+    Evidences without scores (e.g. not ranked by BM25) are all used.
+    """
+    cutoff = config["fid_context_cutoff"]
+    threshold = config["fid_context_threshold"]
+    min_evidences = config["fid_min_evidences"]
+    max_evidences = min(len(evidences), config["fid_max_evidences"])
+    if cutoff == "fixed" or not evidences or any(not "score" in ev for ev in evidences):
+        return max_evidences
+
+    scores = np.maximum(np.array([ev["score"] for ev in evidences[:max_evidences]]), 0.0)
+    if scores[0] <= 0:
+        return max_evidences
+    if cutoff == "ratio":
+        # ranking is sorted by score
+        count = int(np.sum(scores >= threshold * scores[0]))
+    elif cutoff == "mass":
+        mass = np.cumsum(scores) / np.sum(scores)
+        count = int(np.searchsorted(mass, threshold - 1e-9)) + 1
+    else:
+        raise Exception(f"Unknown context cutoff: {cutoff}")
+    return max(min(count, max_evidences), min(min_evidences, max_evidences))
+
+
+def pack_evidences(config, question, evidences):
+    """
+    Pack the (ranked) evidences into FiD passages, based on the tokens of the reader.
+    Duplicate and near-empty passages are dropped, and (optionally) KB-facts
+    of the same entity are merged into one passage, as long as the passage
+    (incl. question and title) fits into `fid_text_maxlength` tokens.
+    At most `fid_max_evidences` passages are returned.
+    """
+    max_passages = config["fid_max_evidences"]
+    max_length = config["fid_text_maxlength"]
+    min_tokens = config["fid_min_passage_tokens"]
+    merge_kb_facts = config["fid_merge_kb_facts"]
+
+    # count tokens (as FiD encodes passages: "question: ... title: ... context: ...")
+    token_cache = get_token_cache(config)
+    texts = [evidence["evidence_text"] for evidence in evidences]
+    text_lengths = token_cache.num_tokens(texts)
+    prefix_length = sum(token_cache.num_tokens(["question:", question, "title:", "context:"]))
+
+    passages = list()
+    passage_lengths = list()
+    seen = set()
+    entity_to_passage = dict()
+    for evidence, text, text_length in zip(evidences, texts, text_lengths):
+        title = evidence["retrieved_for_entity"]["label"]
+
+        # drop near-empty and duplicate passages
+        if text_length < min_tokens or (title, text) in seen:
+            continue
+        seen.add((title, text))
+
+        # merge KB-facts of same entity (if passage has space left)
+        entity_id = evidence["retrieved_for_entity"]["id"]
+        if merge_kb_facts and evidence["source"] == "kb" and entity_id in entity_to_passage:
+            index = entity_to_passage[entity_id]
+            title_length = token_cache.num_tokens([title])[0]
+            merged_length = passage_lengths[index] + 1 + text_length
+            if prefix_length + title_length + merged_length <= max_length:
+                passages[index]["text"] = f"{passages[index]['text']}; {text}"
+                passage_lengths[index] = merged_length
+                continue
+
+        if len(passages) >= max_passages:
+            continue
+        if merge_kb_facts and evidence["source"] == "kb":
+            entity_to_passage[entity_id] = len(passages)
+        passages.append({"title": title, "text": text})
+        passage_lengths.append(text_length)
+    return passages
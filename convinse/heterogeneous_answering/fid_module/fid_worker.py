@@ -0,0 +1,225 @@
+"""
+Resident FiD reader, running in the `fid` environment.
+The model is loaded once, and requests are then answered via a
+line-based JSON protocol on stdin/stdout:
+    request:  {"id": <request ID>, "instances": [<prepared instance>, ...]}
+              (instances with token IDs, or texts in FiD format)
+    response: {"id": <request ID>, "answers": {<question_id>: <generated answer>}}
+Once the model is loaded, {"status": "ready"} is written.
+All other output (e.g. of FiD) is redirected to stderr.
+NOTE: this script is run with the Python of the `fid` environment (Python 3.6),
+and does not import anything from the convinse package.
+"""
+
+import sys
+import json
+import argparse
+
+# keep stdout for the protocol
+protocol_out = sys.stdout
+sys.stdout = sys.stderr
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fid_path", type=str, required=True)
+    parser.add_argument("--model_path", type=str, required=True)
+    parser.add_argument("--n_context", type=int, default=100)
+    parser.add_argument("--per_gpu_batch_size", type=int, default=1)
+    parser.add_argument("--text_maxlength", type=int, default=200)
+    parser.add_argument("--answer_maxlength", type=int, default=50)
+    # dynamic batching (0: fixed batches of per_gpu_batch_size)
+    parser.add_argument("--batch_token_budget", type=int, default=0)
+    # inference profile
+    parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--quantize", action="store_true")
+    return parser.parse_args()
+
+
+class FiDWorker:
+    def __init__(self, args):
+        sys.path.insert(0, args.fid_path)
+        import torch
+        import transformers
+        import src.data
+        import src.model
+
+        self.torch = torch
+        self.transformers = transformers
+        self.src_data = src.data
+        self.args = args
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if args.num_threads > 0:
+            torch.set_num_threads(args.num_threads)
+
+        # load tokenizer and model (once)
+        self.tokenizer = transformers.T5Tokenizer.from_pretrained("t5-base", return_dict=False)
+        self.collator = src.data.Collator(args.text_maxlength, self.tokenizer)
+        self.model = src.model.FiDT5.from_pretrained(args.model_path)
+        self.model = self.model.to(self.device)
+        self.model.eval()
+
+        # dynamic int8 quantization of linear layers (CPU only)
+        if args.quantize and self.device.type == "cpu":
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+        # inference_mode is only available in more recent versions of torch
+        if hasattr(torch, "inference_mode"):
+            self.no_grad = torch.inference_mode
+        else:
+            self.no_grad = torch.no_grad
+
+    def answer(self, examples):
+        """
+        Generate answers for the given prepared instances.
+        Instances either carry token IDs (question_ids, passage_ids),
+        or texts in FiD format (question, ctxs).
+        """
+        answers = dict()
+        with self.no_grad():
+            for batch in self.batches(examples):
+                if all("passage_ids" in example for example in batch):
+                    context_ids, context_mask = self.encode_tokenized(batch)
+                else:
+                    context_ids, context_mask = self.encode_texts(batch)
+                outputs = self.generate(context_ids.to(self.device), context_mask.to(self.device))
+                for example, output in zip(batch, outputs):
+                    answer = self.tokenizer.decode(output, skip_special_tokens=True)
+                    answers[str(example["id"])] = answer.strip()
+        return answers
+
+    def batches(self, examples):
+        """
+        Split the instances into batches. Pre-tokenized instances are sorted by their
+        number of passages and passage length, and batched as long as the padded batch
+        (instances x passages x tokens) fits into the token budget.
+        Otherwise, instances are batched in the given order with fixed batch size.
+        Answers are keyed by question ID, such that the original order can be restored.
+        """
+        budget = self.args.batch_token_budget
+        if budget <= 0 or not all("passage_ids" in example for example in examples):
+            batch_size = self.args.per_gpu_batch_size
+            return [
+                examples[start : start + batch_size]
+                for start in range(0, len(examples), batch_size)
+            ]
+
+        # padded size of each instance
+        sizes = list()
+        for example in examples:
+            passage_ids = example["passage_ids"][: self.args.n_context]
+            n_passages = max(len(passage_ids), 1)
+            length = (
+                len(example["question_ids"]) + max([len(ids) for ids in passage_ids] or [0]) + 1
+            )
+            sizes.append((n_passages, min(length, self.args.text_maxlength)))
+        order = sorted(range(len(examples)), key=lambda i: sizes[i])
+
+        # greedily fill batches up to the token budget (at least one instance per batch)
+        batches = list()
+        batch = list()
+        max_passages, max_length = 0, 0
+        for i in order:
+            n_passages, length = sizes[i]
+            new_passages, new_length = max(max_passages, n_passages), max(max_length, length)
+            if batch and (len(batch) + 1) * new_passages * new_length > budget:
+                batches.append(batch)
+                batch = list()
+                new_passages, new_length = n_passages, length
+            batch.append(examples[i])
+            max_passages, max_length = new_passages, new_length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def encode_texts(self, examples):
+        """Tokenize and encode the instances (as done in test_reader.py)."""
+        # same defaults as src.data.load_data
+        for example in examples:
+            for k, context in enumerate(example["ctxs"]):
+                if not "score" in context:
+                    context["score"] = 1.0 / (k + 1)
+        dataset = self.src_data.Dataset(examples, self.args.n_context)
+        _, _, _, context_ids, context_mask = self.collator(
+            [dataset[i] for i in range(len(dataset))]
+        )
+        return context_ids, context_mask
+
+    def encode_tokenized(self, examples):
+        """
+        Encode the pre-tokenized instances: each passage is the question followed by
+        the passage tokens, truncated to text_maxlength (incl. the EOS token).
+        Passages are only padded to the longest passage in the batch, and instances
+        with less passages are padded with fully masked passages.
+        """
+        max_length = self.args.text_maxlength
+        eos_id = self.tokenizer.eos_token_id
+        pad_id = self.tokenizer.pad_token_id
+        sequences = list()
+        for example in examples:
+            question_ids = example["question_ids"]
+            sequences.append(
+                [
+                    (question_ids + passage_ids)[: max_length - 1] + [eos_id]
+                    for passage_ids in example["passage_ids"][: self.args.n_context]
+                ]
+            )
+        n_passages = max(len(passages) for passages in sequences)
+        length = max(len(ids) for passages in sequences for ids in passages)
+
+        shape = (len(examples), n_passages, length)
+        context_ids = self.torch.full(shape, pad_id, dtype=self.torch.long)
+        context_mask = self.torch.zeros(shape, dtype=self.torch.bool)
+        for i, passages in enumerate(sequences):
+            for j, ids in enumerate(passages):
+                context_ids[i, j, : len(ids)] = self.torch.tensor(ids, dtype=self.torch.long)
+                context_mask[i, j, : len(ids)] = True
+        return context_ids, context_mask
+
+    def generate(self, context_ids, context_mask):
+        """
+        Same as FiDT5.generate, with the decoding strategy (greedy or beam search)
+        set by the number of beams.
+        """
+        self.model.encoder.n_passages = context_ids.size(1)
+        return self.transformers.T5ForConditionalGeneration.generate(
+            self.model,
+            input_ids=context_ids.view(context_ids.size(0), -1),
+            attention_mask=context_mask.view(context_mask.size(0), -1),
+            max_length=self.args.answer_maxlength,
+            num_beams=self.args.num_beams,
+        )
+
+    def handle(self, request):
+        """Handle a single request."""
+        return {"id": request["id"], "answers": self.answer(request["instances"])}
+
+
+def respond(response):
+    protocol_out.write(json.dumps(response))
+    protocol_out.write("\n")
+    protocol_out.flush()
+
+
+def main():
+    args = parse_args()
+    worker = FiDWorker(args)
+    respond({"status": "ready"})
+
+    # serve requests until stdin is closed
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            response = worker.handle(request)
+        except Exception as e:
+            response = {"id": request.get("id"), "error": "{}: {}".format(type(e).__name__, e)}
+        respond(response)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import pytest
+
+from convinse.heterogeneous_answering.fid_module.answer_cache import AnswerCache, ANSWER_CONFIG_KEYS
+
+
+def _instance(question_ids, passage_ids):
+    return {"question_id": "1", "question_ids": question_ids, "passage_ids": passage_ids}
+
+
+@pytest.fixture
+def config(tmp_path):
+    model_path = tmp_path / "model"
+    model_path.mkdir()
+    (model_path / "pytorch_model.bin").write_bytes(b"weights")
+    return {
+        "log_level": "WARNING",
+        "fid_answer_cache_path": str(tmp_path / "fid" / "answers.pickle"),
+        "fid_model_path": str(model_path),
+        "fid_max_evidences": 100,
+        "fid_text_maxlength": 250,
+        "fid_num_beams": 1,
+        "fid_quantize": False,
+    }
+
+
+def test_get_returns_answer_set_for_instance(config):
+    answer_cache = AnswerCache(config)
+    instance = _instance([1, 2], [[3, 4], [5]])
+    assert answer_cache.get(instance) is None
+    answer_cache.set(instance, "Paris")
+    assert answer_cache.get(instance) == "Paris"
+    # any change of the question or passages gives a different key
+    assert answer_cache.get(_instance([1, 2], [[3, 4]])) is None
+    assert answer_cache.get(_instance([1, 2], [[5], [3, 4]])) is None
+    assert answer_cache.get(_instance([1], [[3, 4], [5]])) is None
+
+
+def test_store_merges_caches_of_processes(config):
+    first = AnswerCache(config)
+    second = AnswerCache(config)
+    first.set(_instance([1], [[2]]), "a")
+    second.set(_instance([3], [[4]]), "b")
+    first.store()
+    second.store()
+
+    reloaded = AnswerCache(config)
+    assert reloaded.get(_instance([1], [[2]])) == "a"
+    assert reloaded.get(_instance([3], [[4]])) == "b"
+    assert len(reloaded.answers) == 2
+
+
+@pytest.mark.parametrize("key", ANSWER_CONFIG_KEYS[1:])
+def test_answers_depend_on_config(config, key):
+    instance = _instance([1], [[2]])
+    answer_cache = AnswerCache(config)
+    answer_cache.set(instance, "a")
+    answer_cache.store()
+
+    changed_config = dict(config)
+    changed_config[key] = not config[key] if isinstance(config[key], bool) else config[key] + 1
+    assert AnswerCache(changed_config).get(instance) is None
+    assert AnswerCache(config).get(instance) == "a"
+
+
+def test_answers_depend_on_model_checkpoint(config):
+    instance = _instance([1], [[2]])
+    answer_cache = AnswerCache(config)
+    answer_cache.set(instance, "a")
+    answer_cache.store()
+
+    # re-trained model (weights with a different modification time)
+    weights_path = os.path.join(config["fid_model_path"], "pytorch_model.bin")
+    mtime = os.path.getmtime(weights_path)
+    os.utime(weights_path, (mtime + 10, mtime + 10))
+    assert AnswerCache(config).get(instance) is None
@@ -0,0 +1,65 @@
+import sys
+import pytest
+
+from convinse.heterogeneous_answering.fid_module.fid_reader import FiDReader, FiDReaderPool
+
+# fake FiD worker: answers each question with its ID, and dies on question "die"
+FAKE_WORKER = """
+import sys
+import json
+
+print(json.dumps({"status": "ready"}), flush=True)
+for line in sys.stdin:
+    request = json.loads(line)
+    answers = dict()
+    for instance in request["instances"]:
+        if instance["question_id"] == "die":
+            sys.exit(1)
+        answers[instance["question_id"]] = "answer " + instance["question_id"]
+    print(json.dumps({"id": request["id"], "answers": answers}), flush=True)
+"""
+
+
+@pytest.fixture
+def command(tmp_path):
+    worker_path = tmp_path / "fake_worker.py"
+    worker_path.write_text(FAKE_WORKER)
+    return [sys.executable, str(worker_path)]
+
+
+def _instances(question_ids):
+    return [{"question_id": question_id, "ctxs": list()} for question_id in question_ids]
+
+
+def test_instances_are_sent_in_chunks(command):
+    reader = FiDReader(command, max_request_instances=2)
+    answers = reader.generate(_instances(["1", "2", "3", "4", "5"]))
+    assert answers == {str(i): f"answer {i}" for i in range(1, 6)}
+    assert reader.next_request_id == 3
+    assert reader.num_instances == 5
+    reader.close()
+    assert reader.process is None
+
+
+def test_reader_recovers_after_worker_died(command):
+    reader = FiDReader(command)
+    assert reader.generate(_instances(["1"])) == {"1": "answer 1"}
+    dead_process = reader.process
+
+    with pytest.raises(Exception, match="terminated unexpectedly"):
+        reader.generate(_instances(["die"]))
+    assert reader.process is None
+    assert dead_process.returncode is not None
+
+    # reader is restarted on the next request
+    assert reader.generate(_instances(["2"])) == {"2": "answer 2"}
+    assert reader.process is not dead_process
+    reader.close()
+
+
+def test_pool_merges_answers_of_all_readers(command):
+    pool = FiDReaderPool(command, 2)
+    answers = pool.generate(_instances(["1", "2", "3"]))
+    assert answers == {str(i): f"answer {i}" for i in range(1, 4)}
+    assert sum(stats["instances"] for stats in pool.stats()) == 3
+    pool.close()
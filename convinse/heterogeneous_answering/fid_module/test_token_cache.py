@@ -0,0 +1,112 @@
+import sys
+import types
+import importlib
+import pytest
+
+
+class FakeTokenizer:
+    """Word-level tokenizer (one ID per word), recording the texts it tokenized."""
+
+    tokenized = list()
+
+    @classmethod
+    def from_pretrained(cls, name):
+        return cls()
+
+    def __len__(self):
+        return 100
+
+    def __call__(self, texts, add_special_tokens=True):
+        FakeTokenizer.tokenized += texts
+        return {"input_ids": [[len(word) for word in text.split()] for text in texts]}
+
+
+@pytest.fixture
+def token_cache_module(monkeypatch):
+    # the FiD tokenizer is not required (nor downloaded) for testing the cache
+    transformers = types.ModuleType("transformers")
+    transformers.__version__ = "0.0.0"
+    transformers.T5Tokenizer = FakeTokenizer
+    monkeypatch.setitem(sys.modules, "transformers", transformers)
+    monkeypatch.delitem(
+        sys.modules, "convinse.heterogeneous_answering.fid_module.token_cache", raising=False
+    )
+    FakeTokenizer.tokenized = list()
+    return importlib.import_module("convinse.heterogeneous_answering.fid_module.token_cache")
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {
+        "log_level": "WARNING",
+        "fid_token_cache_path": str(tmp_path / "fid" / "tokens.pickle"),
+        "fid_reader_transformers_version": "3.0.2",
+    }
+
+
+def test_texts_are_tokenized_once(token_cache_module, config):
+    token_cache = token_cache_module.TokenCache(config)
+    ids = token_cache.encode(["a bb", "ccc", "a bb"])
+    assert [list(token_ids) for token_ids in ids] == [[1, 2], [3], [1, 2]]
+    assert token_cache.num_tokens(["ccc", "a bb", "dddd e"]) == [1, 2, 2]
+    assert FakeTokenizer.tokenized == ["a bb", "ccc", "dddd e"]
+
+
+def test_store_merges_caches_of_processes(token_cache_module, config):
+    first = token_cache_module.TokenCache(config)
+    second = token_cache_module.TokenCache(config)
+    first.encode(["a bb"])
+    second.encode(["ccc"])
+    first.store()
+    second.store()
+
+    FakeTokenizer.tokenized = list()
+    reloaded = token_cache_module.TokenCache(config)
+    assert reloaded.num_tokens(["ccc", "a bb"]) == [1, 2]
+    assert FakeTokenizer.tokenized == list()
+
+
+def test_key_depends_on_transformers_version_of_reader(token_cache_module, config):
+    key = token_cache_module.TokenCache(config)._key("a bb")
+    other_config = dict(config, fid_reader_transformers_version="4.0.0")
+    assert token_cache_module.TokenCache(other_config)._key("a bb") != key
+
+
+def test_token_cache_is_shared_per_path(token_cache_module, config, tmp_path):
+    token_cache = token_cache_module.get_token_cache(config)
+    assert token_cache_module.get_token_cache(dict(config)) is token_cache
+    other_config = dict(config, fid_token_cache_path=str(tmp_path / "other.pickle"))
+    assert token_cache_module.get_token_cache(other_config) is not token_cache
+
+
+def test_ids_match_slow_tokenizer_on_joined_input(config, monkeypatch):
+    """Concatenated IDs of the parts are the IDs FiD computes for the joined passage."""
+    pytest.importorskip("sentencepiece")
+    transformers = pytest.importorskip("transformers")
+    try:
+        tokenizer = transformers.T5Tokenizer.from_pretrained("t5-base", local_files_only=True)
+    except (OSError, ValueError):
+        pytest.skip("t5-base tokenizer not available")
+    monkeypatch.delitem(
+        sys.modules, "convinse.heterogeneous_answering.fid_module.token_cache", raising=False
+    )
+    monkeypatch.delitem(
+        sys.modules, "convinse.heterogeneous_answering.fid_module.fid_utils", raising=False
+    )
+    fid_utils = importlib.import_module("convinse.heterogeneous_answering.fid_module.fid_utils")
+
+    instance = {
+        "id": "1",
+        "question": "Who played Ned Stark in  Game of Thrones?",
+        "ctxs": [
+            {"title": "Game of Thrones", "text": 'Sean Bean as Eddard "Ned" Stark (2011–2012).'},
+            {"title": "", "text": "Winterfell, 1,000 years; co-creators: D. B. Weiss"},
+        ],
+    }
+    tokenized = fid_utils.tokenize_instance(config, instance)
+    question = "question: " + instance["question"]
+    for ctx, passage_ids in zip(instance["ctxs"], tokenized["passage_ids"]):
+        text = question + " title: " + ctx["title"] + " context: " + ctx["text"]
+        assert tokenized["question_ids"] + passage_ids == tokenizer.encode(
+            text, add_special_tokens=False
+        )
@@ -0,0 +1,105 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import transformers
+
+from pathlib import Path
+from filelock import FileLock
+from transformers import T5Tokenizer
+
+from convinse.library.utils import get_logger
+
+# token caches shared within the process (one per cache path)
+_TOKEN_CACHES = dict()
+
+
+def get_token_cache(config):
+    """Get the token cache for the given config (loaded once per process)."""
+    cache_path = config["fid_token_cache_path"]
+    if not cache_path in _TOKEN_CACHES:
+        _TOKEN_CACHES[cache_path] = TokenCache(config)
+    return _TOKEN_CACHES[cache_path]
+
+
+class TokenCache:
+    """
+    Persistent cache of the token IDs of texts (evidences, titles) under the
+    tokenizer of the FiD reader, keyed by hash of the tokenizer version and the content.
+    The slow (sentencepiece) T5 tokenizer is used, as in the FiD reader, and the version
+    covers the transformers versions of both the FiD environment and this environment.
+    Token IDs are without special tokens: since the T5 tokenizer does not merge
+    tokens across whitespace, the IDs of "a b" are the IDs of "a" followed by those of "b".
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.logger = get_logger(__name__, config)
+        self.cache_path = config["fid_token_cache_path"]
+
+        # tokenizer of the FiD reader
+        self.tokenizer = T5Tokenizer.from_pretrained("t5-base")
+        reader_version = config["fid_reader_transformers_version"]
+        self.tokenizer_version = (
+            f"t5-base-slow-{reader_version}-{transformers.__version__}-{len(self.tokenizer)}"
+        )
+
+        # initialize cache: hash -> token IDs
+        self._init_cache()
+        self.cache_changed = False
+
+    def encode(self, texts):
+        """Token IDs for each of the given texts (missing texts are tokenized in batch)."""
+        keys = [self._key(text) for text in texts]
+        missing = dict()
+        for key, text in zip(keys, texts):
+            if not key in self.cache and not key in missing:
+                missing[key] = text
+        if missing:
+            texts = list(missing.values())
+            encodings = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+            for key, ids in zip(missing.keys(), encodings):
+                self.cache[key] = np.array(ids, dtype=np.uint16)
+            self.cache_changed = True
+        return [self.cache[key] for key in keys]
+
+    def num_tokens(self, texts):
+        """Number of tokens for each of the given texts."""
+        return [len(ids) for ids in self.encode(texts)]
+
+    def _key(self, text):
+        return hashlib.blake2b(
+            f"{self.tokenizer_version}\n{text}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def store(self):
+        """Store the cache to disk (merged with updates of other processes)."""
+        if not self.cache_changed:
+            return
+        self.logger.info(f"Writing token cache at path {self.cache_path}.")
+        with FileLock(f"{self.cache_path}.lock"):
+            cache = self._read_cache()
+            cache.update(self.cache)
+            self._write_cache(cache)
+        self.cache = cache
+        self.cache_changed = False
+
+    def _init_cache(self):
+        """Initialize the cache."""
+        Path(os.path.dirname(self.cache_path)).mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.cache_path}.lock"):
+            self.cache = self._read_cache()
+
+    def _read_cache(self):
+        """Read the current version of the cache."""
+        if not os.path.isfile(self.cache_path):
+            return dict()
+        with open(self.cache_path, "rb") as fp:
+            return pickle.load(fp)
+
+    def _write_cache(self, cache):
+        """Write to the cache."""
+        cache_dir = os.path.dirname(self.cache_path)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, "wb") as fp:
+            pickle.dump(cache, fp)
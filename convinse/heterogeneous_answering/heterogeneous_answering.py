@@ -31,6 +31,9 @@ class HeterogeneousAnswering:
             output_path = os.path.join(input_dir, qu, ers, sources_string, ha, "test_ha.json")
             self.inference_on_data_split(input_path, output_path, sources)
 
+        # store cache (if applicable)
+        self.store_cache()
+
     def inference_on_data_split(self, input_path, output_path):
         """Run HA on given data split."""
         # open data
@@ -65,3 +68,6 @@ class HeterogeneousAnswering:
         raise Exception(
             "This is an abstract function which should be overwritten in a derived class!"
         )
+
+    def store_cache(self):
+        pass
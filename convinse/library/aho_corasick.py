@@ -0,0 +1,61 @@
+"""
+Multi-pattern string matching based on the Aho-Corasick automaton.
+All occurrences of a set of patterns are found within a single scan of the text.
+"""
+
+from collections import deque
+
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        """Build the automaton for the given patterns (empty patterns are ignored)."""
+        self.patterns = list(patterns)
+        self._goto = [dict()]
+        self._fail = [0]
+        self._out = [list()]
+
+        # build trie
+        for pattern_index, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append(dict())
+                    self._fail.append(0)
+                    self._out.append(list())
+                state = next_state
+            self._out[state].append(pattern_index)
+
+        # add failure links (breadth-first)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and not char in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fail_state = self._goto[fail_state].get(char, 0)
+                self._fail[next_state] = fail_state
+                # patterns ending in the failure state also end in this state
+                self._out[next_state] = self._out[next_state] + self._out[fail_state]
+
+    def iter_matches(self, text):
+        """
+        Find all occurrences of the patterns in the given text.
+        Yields (start, end, pattern_index) tuples, ordered by the end position.
+        """
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for i, char in enumerate(text):
+            while state and not char in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern_index in out[state]:
+                yield i + 1 - len(self.patterns[pattern_index]), i + 1, pattern_index
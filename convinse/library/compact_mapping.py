@@ -0,0 +1,166 @@
+"""
+Compact, read-only mappings from strings to strings (e.g. Wikipedia paths
+to Wikidata IDs), stored as memory-mapped numpy arrays.
+Keys are sorted by a 64-bit hash, and Wikidata IDs are stored as integers.
+Processes opening the same mapping share a single copy (via the page cache).
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from pathlib import Path
+from filelock import FileLock
+
+from convinse.library.utils import get_config
+
+ENT_PATTERN = re.compile("^Q[0-9]+$")
+
+
+def _hash_key(key):
+    """Stable 64-bit hash of the given key (independent of the process)."""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def load_compact_mapping(json_path, compact_path=None, transform=None):
+    """
+    Load the compact version of the mapping in the given .json file.
+    The compact mapping is built once (by default next to the .json file), if it does not exist yet.
+    The optional transform function is applied on each value when building the mapping.
+    """
+    if compact_path is None:
+        compact_path = f"{os.path.splitext(json_path)[0]}.compact"
+    with FileLock(f"{compact_path}.lock"):
+        if not os.path.isdir(compact_path):
+            with open(json_path, "r") as fp:
+                mapping = json.load(fp)
+            if transform:
+                mapping = {key: transform(value) for key, value in mapping.items()}
+                mapping = {key: value for key, value in mapping.items() if not value is None}
+            build_compact_mapping(mapping, compact_path)
+            del mapping
+    return CompactMapping(compact_path)
+
+
+def build_compact_mapping(mapping, compact_path):
+    """Build a compact mapping from the given dict, and store it in the given directory."""
+    keys = list(mapping.keys())
+    values = [mapping[key] for key in keys]
+
+    # sort keys by hash
+    hashes = np.fromiter((_hash_key(key) for key in keys), dtype=np.uint64, count=len(keys))
+    order = np.argsort(hashes, kind="stable")
+    hashes = hashes[order]
+    keys = [keys[i].encode("utf-8") for i in order]
+    values = [values[i] for i in order]
+
+    # store Wikidata IDs as integers
+    if all(isinstance(value, str) and ENT_PATTERN.match(value) for value in values):
+        value_type = "qid"
+    else:
+        value_type = "str"
+
+    # write into temporary directory first (mapping is only visible once complete)
+    tmp_path = f"{compact_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    Path(tmp_path).mkdir(parents=True, exist_ok=True)
+    np.save(os.path.join(tmp_path, "hashes.npy"), hashes)
+    _save_strings(keys, tmp_path, "keys")
+    if value_type == "qid":
+        values = np.array([int(value[1:]) for value in values], dtype=np.uint64)
+        np.save(os.path.join(tmp_path, "values.npy"), values)
+    else:
+        _save_strings([str(value).encode("utf-8") for value in values], tmp_path, "values")
+    with open(os.path.join(tmp_path, "meta.json"), "w") as fp:
+        fp.write(json.dumps({"value_type": value_type, "size": len(keys)}))
+    os.rename(tmp_path, compact_path)
+
+
+def _save_strings(encoded_strings, path, name):
+    """Store the given byte-strings as a single blob with offsets."""
+    offsets = np.zeros(len(encoded_strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded_strings], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded_strings), dtype=np.uint8)
+    np.save(os.path.join(path, f"{name}_offsets.npy"), offsets)
+    np.save(os.path.join(path, f"{name}.npy"), blob)
+
+
+class CompactMapping:
+    """
+    Read-only mapping backed by memory-mapped arrays.
+    Provides the same get-interface as the original dict.
+    """
+
+    def __init__(self, compact_path):
+        self.compact_path = compact_path
+        with open(os.path.join(compact_path, "meta.json"), "r") as fp:
+            meta = json.load(fp)
+        self.value_type = meta["value_type"]
+        self.size = meta["size"]
+
+        # open arrays (read-only, shared across processes)
+        self.hashes = self._load("hashes")
+        self.keys = self._load("keys")
+        self.key_offsets = self._load("keys_offsets")
+        self.values = self._load("values")
+        if self.value_type == "str":
+            self.value_offsets = self._load("values_offsets")
+
+    def get(self, key, default=None):
+        """Look-up the value for the given key."""
+        if not isinstance(key, str) or not self.size:
+            return default
+        key_hash = np.uint64(_hash_key(key))
+        encoded_key = key.encode("utf-8")
+        i = int(np.searchsorted(self.hashes, key_hash))
+        # check all entries with same hash (collisions are possible)
+        while i < self.size and self.hashes[i] == key_hash:
+            if self._key_at(i) == encoded_key:
+                return self._value_at(i)
+            i += 1
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return not self.get(key) is None
+
+    def __len__(self):
+        return self.size
+
+    def _key_at(self, i):
+        return self.keys[self.key_offsets[i] : self.key_offsets[i + 1]].tobytes()
+
+    def _value_at(self, i):
+        if self.value_type == "qid":
+            return f"Q{int(self.values[i])}"
+        return (
+            self.values[self.value_offsets[i] : self.value_offsets[i + 1]].tobytes().decode("utf-8")
+        )
+
+    def _load(self, name):
+        return np.load(os.path.join(self.compact_path, f"{name}.npy"), mmap_mode="r")
+
+
+#######################################################################################################################
+#######################################################################################################################
+if __name__ == "__main__":
+    # RUN: python convinse/library/compact_mapping.py config/convmix/convinse.yml
+    if len(sys.argv) != 2:
+        raise Exception("python convinse/library/compact_mapping.py <PATH_TO_CONFIG>")
+
+    # load config
+    config_path = sys.argv[1]
+    config = get_config(config_path)
+
+    # build compact mappings (if not existing)
+    load_compact_mapping(config["path_to_wikidata_mappings"])
+    load_compact_mapping(config["path_to_wikipedia_mappings"])
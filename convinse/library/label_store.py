@@ -0,0 +1,45 @@
+"""
+Store for the preferred labels of KB items, shared across modules and processes.
+The labels are built once into a memory-mapped compact mapping (holding only
+the preferred label per item), with a small in-process LRU cache in front.
+"""
+
+import os
+
+from functools import lru_cache
+
+from convinse.library.compact_mapping import load_compact_mapping
+from convinse.library.string_library import StringLibrary
+
+LABEL_CACHE_SIZE = 100000
+
+# one label store per labels file (and process)
+_label_stores = dict()
+
+
+def get_label_store(config):
+    """Get the (shared) label store for the labels given in the config."""
+    labels_path = config["path_to_labels"]
+    if not labels_path in _label_stores:
+        _label_stores[labels_path] = LabelStore(labels_path)
+    return _label_stores[labels_path]
+
+
+def _preferred_label(labels):
+    """Get the preferred label among the given labels (None if there is no label)."""
+    if not labels:
+        return None
+    return StringLibrary.get_preferred_label(labels)
+
+
+class LabelStore:
+    def __init__(self, labels_path):
+        compact_path = f"{os.path.splitext(labels_path)[0]}_preferred.compact"
+        self.labels = load_compact_mapping(
+            labels_path, compact_path=compact_path, transform=_preferred_label
+        )
+        self.get_label = lru_cache(maxsize=LABEL_CACHE_SIZE)(self._get_label)
+
+    def _get_label(self, item_id):
+        """Retrieve the preferred label for the given item (item_id if there is none)."""
+        return self.labels.get(item_id, item_id)
@@ -319,12 +319,21 @@ class StringLibrary:
             date = StringLibrary._convert_timestamp_to_date(item_id)
             return date
 
+        # label store: preferred labels are precomputed
+        if hasattr(labels_dict, "get_label"):
+            return labels_dict.get_label(item_id)
+
         # look-up item_id
         labels = labels_dict.get(item_id)
         if not labels:
             return item_id
 
         # only one label
+        return StringLibrary.get_preferred_label(labels)
+
+    @staticmethod
+    def get_preferred_label(labels):
+        """Get the first label that is not an ID (falls back to the first label)."""
         first_label = next(
             (
                 label
@@ -0,0 +1,47 @@
+import random
+
+from convinse.library.aho_corasick import AhoCorasick
+
+
+def _brute_force_matches(patterns, text):
+    matches = list()
+    for pattern_index, pattern in enumerate(patterns):
+        if not pattern:
+            continue
+        start = text.find(pattern)
+        while start != -1:
+            matches.append((start, start + len(pattern), pattern_index))
+            start = text.find(pattern, start + 1)
+    return sorted(matches, key=lambda match: (match[1], match[2]))
+
+
+def test_overlapping_patterns():
+    patterns = ["he", "she", "his", "hers"]
+    matches = list(AhoCorasick(patterns).iter_matches("ushers"))
+    assert sorted(matches) == [(1, 4, 1), (2, 4, 0), (2, 6, 3)]
+
+
+def test_matches_are_ordered_by_end():
+    matches = list(
+        AhoCorasick(["Game of Thrones", "Thrones", "Game"]).iter_matches("Game of Thrones")
+    )
+    assert [end for _, end, _ in matches] == sorted(end for _, end, _ in matches)
+
+
+def test_empty_and_duplicate_patterns():
+    matches = list(AhoCorasick(["", "ab", "ab"]).iter_matches("abab"))
+    assert sorted(matches) == [(0, 2, 1), (0, 2, 2), (2, 4, 1), (2, 4, 2)]
+
+
+def test_random_against_brute_force():
+    random.seed(0)
+    for _ in range(200):
+        patterns = [
+            "".join(random.choice("abc") for _ in range(random.randint(1, 4)))
+            for _ in range(random.randint(1, 6))
+        ]
+        text = "".join(random.choice("abc") for _ in range(random.randint(0, 30)))
+        matches = list(AhoCorasick(patterns).iter_matches(text))
+        assert sorted(matches, key=lambda match: (match[1], match[2])) == _brute_force_matches(
+            patterns, text
+        )
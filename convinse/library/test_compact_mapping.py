@@ -0,0 +1,46 @@
+import convinse.library.compact_mapping as compact_mapping
+from convinse.library.compact_mapping import build_compact_mapping, CompactMapping
+
+
+def _build(mapping, tmp_path):
+    compact_path = str(tmp_path / "mapping.compact")
+    build_compact_mapping(mapping, compact_path)
+    return CompactMapping(compact_path)
+
+
+def test_round_trip_qids(tmp_path):
+    mapping = {"Game_of_Thrones": "Q23572", "Berlin": "Q64", "Café": "Q30022"}
+    compact = _build(mapping, tmp_path)
+    assert compact.value_type == "qid"
+    assert len(compact) == len(mapping)
+    for key, value in mapping.items():
+        assert compact.get(key) == value
+        assert compact[key] == value
+        assert key in compact
+    assert compact.get("Paris") is None
+    assert not "Paris" in compact
+
+
+def test_round_trip_strings(tmp_path):
+    mapping = {"Q23572": "Game_of_Thrones", "Q64": "Berlin", "Q1": "Universe (physics)"}
+    compact = _build(mapping, tmp_path)
+    assert compact.value_type == "str"
+    for key, value in mapping.items():
+        assert compact.get(key) == value
+
+
+def test_colliding_keys(tmp_path, monkeypatch):
+    # all keys of the same length share a hash
+    monkeypatch.setattr(compact_mapping, "_hash_key", lambda key: len(key))
+    mapping = {"ab": "Q1", "cd": "Q2", "ef": "Q3", "abc": "Q4", "x": "Q5"}
+    compact = _build(mapping, tmp_path)
+    for key, value in mapping.items():
+        assert compact.get(key) == value
+    assert compact.get("gh") is None
+    assert compact.get("gh", "default") == "default"
+
+
+def test_empty_mapping(tmp_path):
+    compact = _build(dict(), tmp_path)
+    assert len(compact) == 0
+    assert compact.get("Berlin") is None
@@ -3,7 +3,7 @@ import sys
 import json
 import copy
 
-from convinse.evaluation import answer_presence
+from convinse.evaluation import answer_presence, evaluate_turns, format_results
 from convinse.library.utils import get_config, get_logger, get_result_logger, store_json_with_mkdir
 
 # qu
@@ -111,22 +111,21 @@ class Pipeline:
 			store_json_with_mkdir(input_data, output_path)
 
 			self.ha.inference_on_data(input_data)
+			self.ha.store_cache()
 			output_path = f"{output_dir}/res_{self.name}_gold_answers.json"
 			store_json_with_mkdir(input_data, output_path)
 
 			# compute results
-			p_at_1_list = [turn["p_at_1"] for conv in input_data for turn in conv["questions"]]
-			p_at_1 = sum(p_at_1_list) / len(p_at_1_list)
-			p_at_1 = round(p_at_1, 3)
-			ans_pres_list = [turn["answer_presence"] for conv in input_data for turn in conv["questions"]]
-			ans_pres = sum(ans_pres_list) / len(ans_pres_list)
-			ans_pres = round(ans_pres, 3)
-			num_questions = len(p_at_1_list)
+			results = evaluate_turns([turn for conv in input_data for turn in conv["questions"]])
+			p_at_1 = results["overall"]["p_at_1"]
+			num_questions = results["overall"]["num_questions"]
 
 			# log result
 			res_str = f"Gold answers - {sources_str} - P@1 ({num_questions}): {p_at_1}"
 			self.logger.info(res_str)
 			self.result_logger.info(res_str)
+			for line in format_results(results):
+				self.logger.debug(line)
 
 	def run_with_predicted_answers(self, sources_str):
 		"""
@@ -200,17 +199,19 @@ class Pipeline:
 			store_json_with_mkdir(output_prev_turn, output_path)
 
 		# compute results
-		p_at_1_list = [turn["p_at_1"] for conv in output_prev_turn for turn in conv["questions"]]
-		p_at_1 = sum(p_at_1_list) / len(p_at_1_list)
-		p_at_1 = round(p_at_1, 3)
-		num_questions = len(p_at_1_list)
+		results = evaluate_turns([turn for conv in output_prev_turn for turn in conv["questions"]])
+		p_at_1 = results["overall"]["p_at_1"]
+		num_questions = results["overall"]["num_questions"]
 
 		# log result
 		res_str = f"Pred. answers - {sources_str} - P@1 ({num_questions}): {p_at_1}"
 		self.logger.info(res_str)
+		for line in format_results(results):
+			self.logger.debug(line)
 
 		# store cache
 		self.ers.store_cache()
+		self.ha.store_cache()
 
 	def example(self):
 		"""Run pipeline on a single input turn."""
@@ -2,6 +2,7 @@ import os
 import torch
 import transformers
 
+from tqdm import tqdm
 from pathlib import Path
 import convinse.question_understanding.structured_representation.dataset_structured_representation as dataset
 
@@ -136,7 +137,7 @@ class StructuredRepresentationModel(torch.nn.Module):
 
     def inference_on_batch(self, inputs):
         """Run the model on the given inputs (batch)."""
-        # encode inputs
+        # encode inputs (padded to the longest input in the batch)
         input_encodings = self.tokenizer(
             inputs,
             padding=True,
@@ -144,6 +145,7 @@ class StructuredRepresentationModel(torch.nn.Module):
             max_length=self.config["sr_max_input_length"],
             return_tensors="pt",
         )
+        input_encodings = input_encodings.to(self.model.device)
         # generation
         summary_ids = self.model.generate(
             input_ids=input_encodings["input_ids"],
@@ -153,12 +155,33 @@ class StructuredRepresentationModel(torch.nn.Module):
             early_stopping=self.config["sr_early_stopping"],
         )
         # decoding
-        output = [
-            self.tokenizer.decode(
-                g,
-                skip_special_tokens=True,
-                clean_up_tokenization_spaces=False,
-            )
-            for g in summary_ids
+        srs = self.tokenizer.batch_decode(
+            summary_ids,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True,
+        )
+        # format SRs properly
+        return [self._format_sr(sr) for sr in srs]
+
+    def inference_on_inputs(self, inputs):
+        """
+        Run the model on the given inputs, in batches of `sr_inference_batch_size`.
+        Inputs are sorted by their number of tokens (to reduce padding),
+        and the SRs are returned in the order of the inputs.
+        """
+        batch_size = self.config["sr_inference_batch_size"]
+        lengths = [
+            len(ids)
+            for ids in self.tokenizer(
+                inputs, truncation=True, max_length=self.config["sr_max_input_length"]
+            )["input_ids"]
         ]
-        return output
+        order = sorted(range(len(inputs)), key=lambda i: lengths[i])
+
+        srs = [None] * len(inputs)
+        for start in tqdm(range(0, len(order), batch_size)):
+            indices = order[start : start + batch_size]
+            batch_srs = self.inference_on_batch([inputs[i] for i in indices])
+            for i, sr in zip(indices, batch_srs):
+                srs[i] = sr
+        return srs
@@ -36,6 +36,39 @@ class StructuredRepresentationModule(QuestionUnderstanding):
         self.sr_model.train(train_path, dev_path)
         self.logger.info(f"Finished training.")
 
+    def inference_on_data(self, input_data):
+        """
+        Run inference on the given data. The inputs of all turns are collected
+        first (the history is given by the questions and the gold or predicted answers),
+        and the SRs are then generated in length-sorted batches.
+        With predicted answers, only turns without an SR are collected
+        (the previous turns were already answered).
+        """
+        # load SR model (if required)
+        self._load()
+
+        # collect inputs
+        turns = list()
+        inputs = list()
+        for conversation in input_data:
+            history_turns = list()
+            for i, turn in enumerate(conversation["questions"]):
+                history_turns.append(turn["question"])
+                if self.use_gold_answers or not "structured_representation" in turn:
+                    turns.append(turn)
+                    inputs.append(self.history_separator.join(history_turns))
+
+                # only append answer if there is a next question
+                if i + 1 < len(conversation["questions"]):
+                    history_turns.append(self._answer_text(turn))
+
+        # SR model inference
+        with torch.no_grad():
+            srs = self.sr_model.inference_on_inputs(inputs)
+        for turn, sr in zip(turns, srs):
+            turn["structured_representation"] = sr
+        return input_data
+
     def inference_on_conversation(self, conversation):
         """Run inference on a single conversation."""
         # load SR model (if required)
@@ -49,12 +82,7 @@ class StructuredRepresentationModule(QuestionUnderstanding):
 
                 # only append answer if there is a next question
                 if i + 1 < len(conversation["questions"]):
-                    if self.use_gold_answers:
-                        answer_text = ", ".join([answer["label"] for answer in turn["answers"]])
-                    else:
-                        # answer_text = ", ".join([answer["label"] for answer in turn["pred_answers"]])
-                        answer_text = turn["pred_answers"][0]["label"]
-                    history_turns.append(answer_text)
+                    history_turns.append(self._answer_text(turn))
             return conversation
 
     def inference_on_turn(self, turn, history_turns):
@@ -75,6 +103,13 @@ class StructuredRepresentationModule(QuestionUnderstanding):
             turn["structured_representation"] = sr
             return turn
 
+    def _answer_text(self, turn):
+        """Answer of the given turn, as used in the history of the next turns."""
+        if self.use_gold_answers:
+            return ", ".join([answer["label"] for answer in turn["answers"]])
+        # return ", ".join([answer["label"] for answer in turn["pred_answers"]])
+        return turn["pred_answers"][0]["label"]
+
     def _load(self):
         """Load the SR model."""
         # only load if not already done so